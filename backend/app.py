@@ -1,17 +1,24 @@
 import os
 import re
+import time
 import requests
 import logging
-from flask import Flask, session, request, redirect, url_for, render_template, flash
+from flask import Flask, session, request, redirect, url_for, render_template, flash, jsonify
 from flask_cors import CORS
 from markupsafe import Markup
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
-from datetime import datetime
-from flask_apscheduler import APScheduler
+from datetime import datetime, timedelta
 import spotify_client
-from models import db, User, TrackedPlaylist, DislikedSong, SyncedTrack
+import profile_cache
+import auto_sync
+import sync_queue
+import playlist_copy
+from models import db, User, TrackedPlaylist, DislikedSong, SyncJob
+from sync_engine import add_dislikes
+from session_store import init_sessions, regenerate_session
+from token_cache import TokenCache
 
 # --- Basic Configuration ---
 load_dotenv()
@@ -20,6 +27,8 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 # --- Flask App Initialization ---
 app = Flask(__name__, template_folder='templates')
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
+# The session cookie only carries an ID; the data is kept server-side (see session_store.py)
+init_sessions(app)
 
 # --- CORS Configuration ---
 # Allow requests from GitHub Pages frontend
@@ -30,28 +39,81 @@ CORS(app, origins=cors_origins, supports_credentials=True)
 app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite:///trackify.db")
 db.init_app(app)
 
-# --- Scheduler Configuration ---
-scheduler = APScheduler()
-
 # --- Spotify OAuth Configuration ---
 SCOPE = "playlist-modify-public playlist-read-private playlist-modify-private user-read-private"
-CACHE_HANDLER = spotipy.cache_handler.FlaskSessionCacheHandler(session)
+class NoTokenCacheHandler(spotipy.cache_handler.CacheHandler):
+    """
+    spotipy is only used for the login exchange and for refreshes, so it shouldn't cache tokens itself.
+    Tokens live in token_cache (per user, shared by every pod), not in the session.
+    """
+
+    def get_cached_token(self):
+        return None
+
+    def save_token_to_cache(self, token_info):
+        pass
+
 sp_oauth = SpotifyOAuth(
     client_id=os.getenv("SPOTIPY_CLIENT_ID"),
     client_secret=os.getenv("SPOTIPY_CLIENT_SECRET"),
     redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI"),
     scope=SCOPE,
-    cache_handler=CACHE_HANDLER,
+    cache_handler=NoTokenCacheHandler(),
     show_dialog=True
 )
+token_cache = TokenCache(sp_oauth.refresh_access_token)
 
 # --- Helper Functions ---
 def get_auth_token():
-    """Retrieves the access token from the session cache."""
-    token_info = sp_oauth.get_cached_token()
-    if not token_info:
+    """Returns the signed-in user's access token (refreshed if needed), or None if not logged in."""
+    user = session.get('user')
+    if not user:
+        return None
+    try:
+        return token_cache.get_access_token(user['id'])
+    except Exception as e:
+        # e.g. the user revoked access; they'll have to log in again
+        logging.warning(f"Could not get an access token for user {user['id']}: {e}")
         return None
-    return token_info['access_token']
+
+def remember_user(user_info):
+    """Stores the profile basics we need in the session, so requests don't have to ask Spotify."""
+    session['user'] = {
+        'id': user_info['id'],
+        'display_name': user_info.get('display_name'),
+        'images': (user_info.get('images') or [])[:1],
+    }
+    return session['user']
+
+def get_current_user():
+    """Returns the signed-in user ({'id', 'display_name', 'images'}) from the session, or None if not logged in."""
+    return session.get('user')
+
+def mark_playlists_changed(user_id):
+    """
+    Call after creating or deleting one of the user's playlists. Clears this process's cached
+    listing, and stamps the session so every other pod refetches its copy too (see profile_cache.py).
+    """
+    profile_cache.invalidate_user_playlists(user_id)
+    session['playlists_changed_at'] = time.time()
+
+def mark_tracks_changed(playlist_id):
+    """Like mark_playlists_changed(), for the cached track pages of one playlist."""
+    profile_cache.invalidate_playlist_tracks(playlist_id)
+    now = time.time()
+    fresh_for, _ = profile_cache.TRACKS_TTL
+    # Older stamps can go: every page cached before them has expired by now
+    changed = {changed_id: at for changed_id, at in session.get('tracks_changed_at', {}).items() if at > now - fresh_for}
+    changed[playlist_id] = now
+    session['tracks_changed_at'] = changed
+
+def tracks_changed_at(playlist_id):
+    return session.get('tracks_changed_at', {}).get(playlist_id)
+
+def is_admin(user_id):
+    """Admins are the Spotify user IDs listed in ADMIN_USER_IDS (comma-separated)."""
+    admin_ids = {admin_id.strip() for admin_id in os.getenv("ADMIN_USER_IDS", "").split(",") if admin_id.strip()}
+    return user_id in admin_ids
 
 def parse_playlist_id(url_or_uri):
     """Parses a Spotify URL, URI, or ID to extract just the playlist ID."""
@@ -65,57 +127,6 @@ def parse_playlist_id(url_or_uri):
         return url_or_uri
     return None
 
-# --- Background Job Definition ---
-def run_sync_job(tracked_playlist_db_id):
-    """The function that the scheduler will run in the background."""
-    with app.app_context():
-        logging.info(f"Running auto-sync for playlist ID: {tracked_playlist_db_id}")
-        tracked_playlist = db.session.get(TrackedPlaylist, tracked_playlist_db_id)
-
-        if not tracked_playlist or not tracked_playlist.auto_sync_enabled:
-            logging.warning(f"Job fired for playlist {tracked_playlist_db_id}, but auto-sync is disabled. Stopping.")
-            return
-
-        user = db.session.get(User, tracked_playlist.user_id)
-        if not user or not user.refresh_token:
-            logging.error(f"Cannot sync: User {tracked_playlist.user_id} not found or has no refresh token.")
-            return
-
-        try:
-            # Get a new access token using the refresh token
-            new_token_info = sp_oauth.refresh_access_token(user.refresh_token)
-
-            # Since we got a new token, save the new refresh token if one was returned
-            if 'refresh_token' in new_token_info:
-                user.refresh_token = new_token_info['refresh_token']
-                db.session.commit()
-
-            token = new_token_info['access_token']
-
-            # --- Perform the sync logic (copied and adapted from /sync route) ---
-            source_data = spotify_client.get_playlist_details(token, tracked_playlist.source_playlist_id)
-            source_uris = set(spotify_client.get_all_track_uris(token, source_data))
-
-            tracked_data = spotify_client.get_playlist_details(token, tracked_playlist.tracked_playlist_id)
-            tracked_uris = set(spotify_client.get_all_track_uris(token, tracked_data))
-
-            disliked_songs = db.session.execute(db.select(DislikedSong).where(DislikedSong.tracked_playlist_id == tracked_playlist.id)).scalars().all()
-            disliked_uris_db = {song.song_uri for song in disliked_songs}
-
-            songs_to_add = list(source_uris - tracked_uris - disliked_uris_db)
-
-            if songs_to_add:
-                spotify_client.add_tracks_to_playlist(token, tracked_playlist.tracked_playlist_id, songs_to_add)
-                logging.info(f"Auto-sync for '{tracked_playlist.tracked_playlist_name}' added {len(songs_to_add)} songs.")
-            else:
-                logging.info(f"Auto-sync for '{tracked_playlist.tracked_playlist_name}' complete. No new songs.")
-
-            tracked_playlist.last_synced = datetime.utcnow()
-            db.session.commit()
-        except Exception as e:
-            logging.error(f"Auto-sync job failed for playlist {tracked_playlist_db_id}: {e}")
-
-
 # --- Routes ---
 @app.route('/')
 def index():
@@ -132,18 +143,16 @@ def login():
 
 @app.route('/callback')
 def callback():
-    token_info = sp_oauth.get_access_token(request.args['code'])
+    # Drop any previous user's identity, and the session ID used before login, before signing the new one in
+    session.pop('user', None)
+    regenerate_session(session)
+    token_info = sp_oauth.get_access_token(request.args['code'], check_cache=False)
 
-    # Save the refresh token to the database
+    # Save the tokens to the database, where every pod and the worker can use them
     sp = spotipy.Spotify(auth=token_info['access_token'])
     user_info = sp.current_user()
-    user = db.session.get(User, user_info['id'])
-    if not user:
-        user = User(id=user_info['id'])
-        db.session.add(user)
-
-    user.refresh_token = token_info['refresh_token']
-    db.session.commit()
+    token_cache.store(user_info['id'], token_info)
+    remember_user(user_info)
 
     return redirect(url_for('profile'))
 
@@ -159,48 +168,64 @@ def profile():
     if not token:
         return redirect(url_for('login'))
 
-    sp = spotipy.Spotify(auth=token)
-    user_info = sp.current_user()
-
-    all_user_playlists_response = sp.current_user_playlists(limit=50)
-    all_user_playlists = all_user_playlists_response['items']
-
-    spotify_playlists_by_id = {p['id']: p for p in all_user_playlists}
+    # The playlist listing is served from the metadata cache when warm; see profile_cache.py
+    user_info = get_current_user()
 
     tracked_playlists_from_db = db.session.execute(
         db.select(TrackedPlaylist).where(TrackedPlaylist.user_id == user_info['id'])
     ).scalars().all()
 
-    actual_playlist_ids = {p['id'] for p in all_user_playlists}
+    listing, playlists_fetched_at = profile_cache.user_playlists(
+        token, user_info['id'], {tp.tracked_playlist_id for tp in tracked_playlists_from_db},
+        changed_at=session.get('playlists_changed_at')
+    )
+    all_user_playlists = listing.items
+    spotify_playlists_by_id = {p['id']: p for p in all_user_playlists}
+
+    # Tracked playlists missing from the listing, except ones still being copied or synced since it
+    # was fetched (a cached listing may just not include them yet)
+    unlisted_playlists = [
+        tp for tp in tracked_playlists_from_db
+        if tp.tracked_playlist_id not in spotify_playlists_by_id
+        and not tp.copy_in_progress
+        and not (tp.last_synced and tp.last_synced > datetime.utcfromtimestamp(playlists_fetched_at))
+    ]
+
+    # Only a complete listing proves a playlist is gone; otherwise ask Spotify about each one
+    if listing.complete:
+        playlists_to_delete_from_db = unlisted_playlists
+    else:
+        followed = profile_cache.followed_playlists(token, user_info['id'], [tp.tracked_playlist_id for tp in unlisted_playlists])
+        playlists_to_delete_from_db = [tp for tp in unlisted_playlists if followed.get(tp.tracked_playlist_id) is False]
+
+    # Every playlist's queued or running job, in one query
+    active_jobs = sync_queue.get_active_jobs([tp.id for tp in tracked_playlists_from_db])
 
     valid_tracked_playlists = []
-    playlists_to_delete_from_db = []
-
     for tp in tracked_playlists_from_db:
-        if tp.tracked_playlist_id in actual_playlist_ids:
-            playlist_details = spotify_playlists_by_id.get(tp.tracked_playlist_id)
-            if playlist_details and playlist_details.get('images'):
-                tp.cover_image_url = playlist_details['images'][0]['url']
-            else:
-                tp.cover_image_url = None
-
-            if tp.last_synced:
-                tp.last_synced_formatted = tp.last_synced.strftime('%Y-%m-%d %H:%M')
-            else:
-                tp.last_synced_formatted = 'Never'
-
-            valid_tracked_playlists.append(tp)
-        else:
+        if tp in playlists_to_delete_from_db:
             logging.info(f"Tracked playlist '{tp.tracked_playlist_name}' (ID: {tp.tracked_playlist_id}) not found on Spotify. Deleting from DB.")
-            playlists_to_delete_from_db.append(tp)
+            continue
+
+        playlist_details = spotify_playlists_by_id.get(tp.tracked_playlist_id)
+        if playlist_details and playlist_details.get('images'):
+            tp.cover_image_url = playlist_details['images'][0]['url']
+        else:
+            tp.cover_image_url = None
+
+        if tp.last_synced:
+            tp.last_synced_formatted = tp.last_synced.strftime('%Y-%m-%d %H:%M')
+        else:
+            tp.last_synced_formatted = 'Never'
+
+        active_job = active_jobs.get(tp.id)
+        tp.active_sync_job_id = active_job.id if active_job else None
+        tp.active_sync_trigger = active_job.trigger if active_job else None
+
+        valid_tracked_playlists.append(tp)
 
     if playlists_to_delete_from_db:
         for tp in playlists_to_delete_from_db:
-            if tp.job_id:
-                try:
-                    scheduler.remove_job(tp.job_id)
-                except Exception as e:
-                    logging.warning(f"Could not remove job {tp.job_id} for deleted playlist: {e}")
             db.session.execute(
                 db.delete(DislikedSong).where(DislikedSong.tracked_playlist_id == tp.id)
             )
@@ -211,16 +236,11 @@ def profile():
     tracked_source_ids = {tp.source_playlist_id for tp in valid_tracked_playlists}
     tracked_playlist_ids = {tp.tracked_playlist_id for tp in valid_tracked_playlists}
 
-    source_playlists = []
-    for playlist_id in tracked_source_ids:
-        if playlist_id in spotify_playlists_by_id:
-            source_playlists.append(spotify_playlists_by_id[playlist_id])
-        else:
-            try:
-                playlist_data = sp.playlist(playlist_id)
-                source_playlists.append(playlist_data)
-            except Exception as e:
-                logging.error(f"Could not fetch source playlist {playlist_id}: {e}")
+    # Sources the user doesn't follow are fetched in parallel (and cached across users)
+    source_playlists = [spotify_playlists_by_id[playlist_id] for playlist_id in tracked_source_ids if playlist_id in spotify_playlists_by_id]
+    source_playlists += profile_cache.playlists_metadata(
+        token, [playlist_id for playlist_id in tracked_source_ids if playlist_id not in spotify_playlists_by_id]
+    )
 
     return render_template(
         'profile.html',
@@ -247,9 +267,7 @@ def track():
         return redirect(url_for('profile'))
 
     try:
-        sp = spotipy.Spotify(auth=token)
-        user_info = sp.current_user()
-        user_id = user_info.get('id')
+        user_id = get_current_user()['id']
 
         existing_tracking = db.session.execute(db.select(TrackedPlaylist).where(
             TrackedPlaylist.user_id == user_id,
@@ -266,9 +284,8 @@ def track():
             db.session.add(user)
             db.session.commit()
 
-        source_playlist = spotify_client.get_playlist_details(token, source_playlist_id)
+        source_playlist = spotify_client.get_playlist_header(token, source_playlist_id)
         source_playlist_name = source_playlist['name']
-        track_uris = spotify_client.get_all_track_uris(token, source_playlist)
 
         if custom_name:
             new_playlist_name = custom_name
@@ -277,29 +294,22 @@ def track():
 
         description = f"Tracked version of '{source_playlist_name}'. Created by the Spotify Playlist Tracker."
         new_playlist_id = spotify_client.create_new_playlist(token, user_id, new_playlist_name, description)
-        if track_uris:
-            spotify_client.add_tracks_to_playlist(token, new_playlist_id, track_uris)
+        mark_playlists_changed(user_id)
 
         new_tracked_playlist = TrackedPlaylist(
             user_id=user_id,
             source_playlist_id=source_playlist_id,
             tracked_playlist_id=new_playlist_id,
-            tracked_playlist_name=new_playlist_name,
-            last_synced=datetime.utcnow()
+            tracked_playlist_name=new_playlist_name
         )
+        playlist_copy.start_copy(new_tracked_playlist)
         db.session.add(new_tracked_playlist)
         db.session.commit()
 
-        if track_uris:
-            for uri in track_uris:
-                snapshot_track = SyncedTrack(
-                    track_uri=uri,
-                    tracked_playlist_id=new_tracked_playlist.id
-                )
-                db.session.add(snapshot_track)
-            db.session.commit()
+        # The songs are copied by the sync worker; the profile page shows its progress
+        sync_queue.enqueue_sync(new_tracked_playlist.id, 'copy')
 
-        flash(f"Successfully created and tracked '{new_playlist_name}'!", 'success')
+        flash(f"Successfully created and tracked '{new_playlist_name}'! Its songs are being copied now.", 'success')
 
     except requests.exceptions.HTTPError as e:
         flash(f"A Spotify API error occurred: {e.response.status_code}. Please try again later.", 'error')
@@ -319,85 +329,49 @@ def sync(tracked_playlist_db_id):
         flash("Tracked playlist not found in database.", 'error')
         return redirect(url_for('profile'))
 
-    sp = spotipy.Spotify(auth=token)
-    user_info = sp.current_user()
-    if tracked_playlist.user_id != user_info.get('id'):
+    if tracked_playlist.user_id != get_current_user()['id']:
         flash("You do not have permission to sync this playlist.", 'error')
         return redirect(url_for('profile'))
 
-    try:
-        # --- STEP 1: Get all current states ---
-        # Get songs from the original source playlist on Spotify
-        source_data = spotify_client.get_playlist_details(token, tracked_playlist.source_playlist_id)
-        source_uris = set(spotify_client.get_all_track_uris(token, source_data))
-
-        # Get songs currently in the user's tracked playlist on Spotify
-        tracked_data = spotify_client.get_playlist_details(token, tracked_playlist.tracked_playlist_id)
-        current_tracked_uris = set(spotify_client.get_all_track_uris(token, tracked_data))
-
-        # Get the snapshot of tracks from our DB from the LAST successful sync
-        previous_synced_tracks = db.session.execute(
-            db.select(SyncedTrack).where(SyncedTrack.tracked_playlist_id == tracked_playlist.id)
-        ).scalars().all()
-        previous_synced_uris = {t.track_uri for t in previous_synced_tracks}
-
-        # Get all songs the user has ever disliked for this playlist
-        disliked_songs_db = db.session.execute(
-            db.select(DislikedSong).where(DislikedSong.tracked_playlist_id == tracked_playlist.id)
-        ).scalars().all()
-        disliked_uris = {s.song_uri for s in disliked_songs_db}
-
-        # --- STEP 2: Find songs the user manually removed (the new "disliked" songs) ---
-        # A song was removed by the user if it was in our last snapshot, but is NOT in the playlist now.
-        newly_disliked_uris = previous_synced_uris - current_tracked_uris
-        
-        if newly_disliked_uris:
-            for uri in newly_disliked_uris:
-                # Add to disliked table only if it's not already there
-                if uri not in disliked_uris:
-                    disliked_song = DislikedSong(song_uri=uri, tracked_playlist_id=tracked_playlist.id)
-                    db.session.add(disliked_song)
-            
-            # Update our in-memory set of disliked songs for the next step
-            disliked_uris.update(newly_disliked_uris)
-            logging.info(f"Recorded {len(newly_disliked_uris)} newly disliked songs.")
-
-        # --- STEP 3: Find new songs to add to the tracked playlist ---
-        # A song should be added if it's in the source, not already in the tracked playlist, 
-        # AND not in our master list of disliked songs.
-        songs_to_add = list(source_uris - current_tracked_uris - disliked_uris)
-
-        if songs_to_add:
-            spotify_client.add_tracks_to_playlist(token, tracked_playlist.tracked_playlist_id, songs_to_add)
-            flash(f"Sync complete! Added {len(songs_to_add)} new song(s).", 'success')
-        else:
-            flash("Sync complete! Your playlist is up to date.", 'success')
-
-        # --- STEP 4: Update the DB snapshot to the new state ---
-        # The new "correct" state is what's currently on Spotify plus the songs we just added.
-        new_snapshot_uris = current_tracked_uris.union(songs_to_add)
-        
-        # Delete the old snapshot
-        db.session.execute(db.delete(SyncedTrack).where(SyncedTrack.tracked_playlist_id == tracked_playlist.id))
-        
-        # Save the new snapshot
-        for uri in new_snapshot_uris:
-            db.session.add(SyncedTrack(track_uri=uri, tracked_playlist_id=tracked_playlist.id))
-
-        # Finally, update the sync timestamp and commit all changes
-        tracked_playlist.last_synced = datetime.utcnow()
-        db.session.commit()
+    # An unfinished initial copy has to finish before the playlist can be synced
+    if tracked_playlist.copy_in_progress:
+        sync_queue.enqueue_sync(tracked_playlist.id, 'copy')
+        flash(f"Resumed copying songs into '{tracked_playlist.tracked_playlist_name}'.", 'info')
+        return redirect(url_for('profile'))
 
-    except requests.exceptions.HTTPError as e:
-        db.session.rollback() # Rollback DB changes on error
-        flash(f"A Spotify API error occurred during sync: {e.response.status_code} - {e.response.text}", 'error')
-    except Exception as e:
-        db.session.rollback()
-        flash(f"An unexpected error occurred during sync: {e}", 'error')
-        logging.error(f"Sync error for playlist {tracked_playlist_db_id}: {e}", exc_info=True)
+    # The sync itself runs in the sync worker (worker.py); the page polls /sync_status
+    sync_queue.enqueue_sync(tracked_playlist.id, 'manual')
+    flash(f"Sync started for '{tracked_playlist.tracked_playlist_name}'.", 'info')
 
     return redirect(url_for('profile'))
 
+@app.route('/sync_status/<int:job_id>')
+def sync_status(job_id):
+    token = get_auth_token()
+    if not token:
+        return jsonify({'error': 'Not logged in.'}), 401
+
+    job = db.session.get(SyncJob, job_id)
+    if not job:
+        return jsonify({'error': 'Sync job not found.'}), 404
+
+    tracked_playlist = db.session.get(TrackedPlaylist, job.tracked_playlist_id)
+    if tracked_playlist.user_id != get_current_user()['id']:
+        return jsonify({'error': 'Sync job not found.'}), 404
+
+    return jsonify({
+        'id': job.id,
+        'tracked_playlist_id': job.tracked_playlist_id,
+        'trigger': job.trigger,
+        'status': job.status,
+        'result': job.result,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'copy_done': tracked_playlist.copy_done,
+        'copy_total': tracked_playlist.copy_total,
+    })
+
 @app.route('/toggle_auto_sync/<int:tracked_playlist_db_id>', methods=['POST'])
 def toggle_auto_sync(tracked_playlist_db_id):
     if not get_auth_token():
@@ -408,25 +382,11 @@ def toggle_auto_sync(tracked_playlist_db_id):
         flash("Playlist not found.", "error")
         return redirect(url_for('profile'))
 
-    tracked_playlist.auto_sync_enabled = not tracked_playlist.auto_sync_enabled
-
+    # The schedule lives on the row itself, so every pod sees it and it survives restarts
     if tracked_playlist.auto_sync_enabled:
-        job = scheduler.add_job(
-            id=f'sync_{tracked_playlist.id}',
-            func=run_sync_job,
-            args=[tracked_playlist.id],
-            trigger='interval',
-            weeks=1,
-            replace_existing=True
-        )
-        tracked_playlist.job_id = job.id
+        auto_sync.disable_auto_sync(tracked_playlist)
     else:
-        if tracked_playlist.job_id:
-            try:
-                scheduler.remove_job(tracked_playlist.job_id)
-            except Exception as e:
-                logging.warning(f"Could not remove job {tracked_playlist.job_id}: {e}")
-        tracked_playlist.job_id = None
+        auto_sync.enable_auto_sync(tracked_playlist)
 
     db.session.commit()
     return redirect(url_for('profile'))
@@ -441,12 +401,6 @@ def untrack(tracked_playlist_db_id):
         flash("Playlist not found in tracking database.", 'error')
         return redirect(url_for('profile'))
 
-    if playlist_to_untrack.job_id:
-        try:
-            scheduler.remove_job(playlist_to_untrack.job_id)
-        except Exception as e:
-            logging.warning(f"Could not remove job {playlist_to_untrack.job_id} during untrack: {e}")
-
     session['undo_data'] = {
         'user_id': playlist_to_untrack.user_id,
         'source_playlist_id': playlist_to_untrack.source_playlist_id,
@@ -459,7 +413,10 @@ def untrack(tracked_playlist_db_id):
     db.session.commit()
 
     undo_url = url_for('undo_untrack')
-    message = Markup(f"Successfully untracked '{playlist_to_untrack.tracked_playlist_name}'. <a href='{undo_url}' class='font-bold underline'>Undo</a>")
+    # Markup.format escapes the playlist name, which the user chose
+    message = Markup("Successfully untracked '{}'. <a href='{}' class='font-bold underline'>Undo</a>").format(
+        playlist_to_untrack.tracked_playlist_name, undo_url
+    )
     flash(message, 'success')
 
     return redirect(url_for('profile'))
@@ -494,20 +451,14 @@ def delete_playlist(tracked_playlist_db_id):
         flash("Playlist not found in tracking database.", 'error')
         return redirect(url_for('profile'))
 
-    sp = spotipy.Spotify(auth=get_auth_token())
-    user_info = sp.current_user()
-    if playlist_to_delete.user_id != user_info.get('id'):
+    if playlist_to_delete.user_id != get_current_user()['id']:
         flash("You do not have permission to delete this playlist.", 'error')
         return redirect(url_for('profile'))
 
     try:
-        if playlist_to_delete.job_id:
-            try:
-                scheduler.remove_job(playlist_to_delete.job_id)
-            except Exception as e:
-                logging.warning(f"Could not remove job {playlist_to_delete.job_id} during delete: {e}")
-
+        sp = spotipy.Spotify(auth=get_auth_token())
         sp.current_user_unfollow_playlist(playlist_to_delete.tracked_playlist_id)
+        mark_playlists_changed(playlist_to_delete.user_id)
         logging.info(f"Unfollowed (deleted) playlist {playlist_to_delete.tracked_playlist_id} from Spotify.")
 
         db.session.execute(db.delete(DislikedSong).where(DislikedSong.tracked_playlist_id == playlist_to_delete.id))
@@ -527,72 +478,163 @@ def edit_playlist(tracked_playlist_db_id):
     if not token:
         return redirect(url_for('login'))
 
-    sp = spotipy.Spotify(auth=token)
-
     tracked_playlist = db.session.get(TrackedPlaylist, tracked_playlist_db_id)
     if not tracked_playlist:
         flash("Playlist not found in tracking database.", 'error')
         return redirect(url_for('profile'))
 
-    try:
-        playlist_data = sp.playlist(tracked_playlist.tracked_playlist_id)
-        playlist_data['db_id'] = tracked_playlist_db_id
+    if tracked_playlist.user_id != get_current_user()['id']:
+        flash("You do not have permission to edit this playlist.", 'error')
+        return redirect(url_for('profile'))
 
+    # Only the first page is rendered here; the page fetches the rest from /playlist_tracks as you scroll
+    try:
+        first_page = profile_cache.playlist_tracks_page(
+            token, tracked_playlist.tracked_playlist_id, changed_at=tracks_changed_at(tracked_playlist.tracked_playlist_id)
+        )
     except Exception as e:
         flash(f"Could not load playlist from Spotify: {e}", 'error')
         return redirect(url_for('profile'))
 
+    playlist_data = {'name': tracked_playlist.tracked_playlist_name, 'db_id': tracked_playlist_db_id}
     return render_template(
         'edit_playlist.html',
         playlist=playlist_data,
-        tracks=playlist_data['tracks']['items']
+        tracks=first_page['tracks'],
+        next_offset=first_page['next_offset'],
+        total=first_page['total']
     )
 
+@app.route('/playlist_tracks/<int:tracked_playlist_db_id>')
+def playlist_tracks(tracked_playlist_db_id):
+    """One page of a tracked playlist's tracks as JSON. Pass the previous page's next_offset as ?offset=."""
+    token = get_auth_token()
+    if not token:
+        return jsonify({'error': 'Not logged in.'}), 401
+
+    tracked_playlist = db.session.get(TrackedPlaylist, tracked_playlist_db_id)
+    if not tracked_playlist or tracked_playlist.user_id != get_current_user()['id']:
+        return jsonify({'error': 'Playlist not found.'}), 404
+
+    offset = request.args.get('offset', 0, type=int)
+    if offset < 0:
+        return jsonify({'error': 'Invalid offset.'}), 400
+
+    try:
+        page = profile_cache.playlist_tracks_page(
+            token, tracked_playlist.tracked_playlist_id, offset, changed_at=tracks_changed_at(tracked_playlist.tracked_playlist_id)
+        )
+    except Exception as e:
+        logging.error(f"Could not load tracks of playlist {tracked_playlist_db_id}: {e}")
+        return jsonify({'error': 'Could not load tracks from Spotify.'}), 502
+
+    return jsonify(page)
+
+def dislike_tracks(token: str, tracked_playlist: TrackedPlaylist, track_uris: list):
+    """
+    Records `track_uris` as disliked (in one insert that skips songs already disliked, so
+    a repeated request is harmless) and removes them from the Spotify playlist, 100 per request.
+    """
+    track_uris = list(dict.fromkeys(track_uris))
+    add_dislikes(tracked_playlist.id, track_uris)
+    db.session.commit()
+    logging.info(f"Disliked {len(track_uris)} song(s) for playlist {tracked_playlist.id}")
+
+    spotify_client.remove_tracks_from_playlist(token, tracked_playlist.tracked_playlist_id, track_uris)
+    mark_tracks_changed(tracked_playlist.tracked_playlist_id)
+
 @app.route('/dislike_song/<int:tracked_playlist_db_id>/<track_uri>', methods=['POST'])
 def dislike_song(tracked_playlist_db_id, track_uri):
     token = get_auth_token()
     if not token:
         return redirect(url_for('login'))
 
-    sp = spotipy.Spotify(auth=token)
-
     tracked_playlist = db.session.get(TrackedPlaylist, tracked_playlist_db_id)
     if not tracked_playlist:
         flash("Tracked playlist not found.", "error")
         return redirect(url_for('profile'))
 
+    if tracked_playlist.user_id != get_current_user()['id']:
+        flash("You do not have permission to edit this playlist.", 'error')
+        return redirect(url_for('profile'))
+
     try:
-        existing_dislike = db.session.execute(db.select(DislikedSong).where(
-            DislikedSong.tracked_playlist_id == tracked_playlist_db_id,
-            DislikedSong.song_uri == track_uri
-        )).scalar_one_or_none()
+        dislike_tracks(token, tracked_playlist, [track_uri])
+        flash("Successfully removed the song and will prevent it from being added back.", "success")
 
-        if not existing_dislike:
-            new_dislike = DislikedSong(song_uri=track_uri, tracked_playlist_id=tracked_playlist_db_id)
-            db.session.add(new_dislike)
-            db.session.commit()
-            logging.info(f"Added {track_uri} to disliked songs for playlist {tracked_playlist_db_id}")
+    except Exception as e:
+        db.session.rollback()
+        flash(f"An error occurred: {e}", "error")
+
+    return redirect(url_for('edit_playlist', tracked_playlist_db_id=tracked_playlist_db_id))
+
+@app.route('/dislike_songs/<int:tracked_playlist_db_id>', methods=['POST'])
+def dislike_songs(tracked_playlist_db_id):
+    """
+    Removes many songs at once. Takes JSON {"tracks": [{"uri": ..., "name": ...}, ...]};
+    the names are the ones the page is already showing, and are only used in the reply.
+    """
+    token = get_auth_token()
+    if not token:
+        return jsonify({'error': 'Not logged in.'}), 401
 
-        track_info = sp.track(track_uri.split(':')[-1])
-        track_name = track_info['name']
-        sp.playlist_remove_all_occurrences_of_items(tracked_playlist.tracked_playlist_id, [track_uri])
+    tracked_playlist = db.session.get(TrackedPlaylist, tracked_playlist_db_id)
+    if not tracked_playlist or tracked_playlist.user_id != get_current_user()['id']:
+        return jsonify({'error': 'Playlist not found.'}), 404
 
-        flash(f"Successfully removed '{track_name}' and will prevent it from being added back.", "success")
+    tracks = (request.get_json(silent=True) or {}).get('tracks')
+    if not isinstance(tracks, list) or not tracks or not all(
+        isinstance(track, dict) and isinstance(track.get('uri'), str) and track['uri'].startswith('spotify:')
+        for track in tracks
+    ):
+        return jsonify({'error': 'Expected a non-empty list of tracks with Spotify URIs.'}), 400
 
+    try:
+        dislike_tracks(token, tracked_playlist, [track['uri'] for track in tracks])
     except Exception as e:
-        flash(f"An error occurred: {e}", "error")
+        db.session.rollback()
+        logging.error(f"Bulk dislike for playlist {tracked_playlist_db_id} failed: {e}", exc_info=True)
+        return jsonify({'error': f"An error occurred: {e}"}), 502
+
+    names = {track['uri']: f"'{track.get('name') or track['uri']}'" for track in tracks}
+    removed = ', '.join(names.values()) if len(names) <= 3 else f"{len(names)} songs"
+    return jsonify({
+        'removed': list(names),
+        'message': f"Successfully removed {removed} and will prevent them from being added back."
+    })
+
+@app.route('/admin/schedule')
+def admin_schedule():
+    token = get_auth_token()
+    if not token:
+        return redirect(url_for('login'))
 
-    return redirect(url_for('edit_playlist', tracked_playlist_db_id=tracked_playlist_db_id))
+    if not is_admin(get_current_user()['id']):
+        flash("You do not have permission to view that page.", 'error')
+        return redirect(url_for('profile'))
 
-# Create the database file and tables if they don't exist
-with app.app_context():
-    db.create_all()
+    load = auto_sync.schedule_load()
 
-# Initialize and start the scheduler
-scheduler.init_app(app)
-scheduler.start()
+    def by_day(start, counts):
+        """Splits hourly counts into one row of 24 per day."""
+        return [
+            ((start + timedelta(days=day)).strftime('%a %H:%M'), counts[day * 24:(day + 1) * 24])
+            for day in range(7)
+        ]
+
+    upcoming = load['upcoming']
+    return render_template(
+        'admin_schedule.html',
+        upcoming_days=by_day(load['upcoming_start'], upcoming),
+        recent_days=by_day(load['recent_start'], load['recent']),
+        scheduled_total=sum(upcoming),
+        peak_per_hour=max(upcoming),
+        average_per_hour=sum(upcoming) / len(upcoming),
+        window_minutes=int(auto_sync.schedule_window().total_seconds() // 60),
+        max_per_window=auto_sync.max_syncs_per_window()
+    )
 
 if __name__ == '__main__':
-    # use_reloader=False is important for APScheduler to avoid running jobs twice
+    # Syncs run in a separate process: start it with `python -m worker`
     debug_mode = os.getenv('FLASK_ENV') == 'development'
     app.run(debug=debug_mode, port=8888, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""
+An asyncio variant of spotify_client for running many syncs on one event loop.
+
+It offers the same calls as spotify_client (playlist header, streamed track
+URIs, create playlist, add tracks) as coroutines on httpx. Rate limiting,
+retries and metrics are shared with the blocking client: every request takes
+a token from the same TokenBucket, a 429 pauses it for threads and coroutines
+alike, and the same backoff rules and counters apply (including the per-run
+counters of spotify_client.count_requests()). The connection pool is
+sized by the same SPOTIFY_HTTP_* settings, but httpx keeps its own sockets.
+
+Errors are raised as requests.exceptions.HTTPError, like the blocking client,
+so callers can handle both the same way.
+"""
+import json
+import asyncio
+import logging
+
+import httpx
+import requests
+
+import spotify_client
+from spotify_client import API_BASE_URL, IDEMPOTENT_METHODS, MAX_PAGE_SIZE, TRACK_URI_FIELDS
+
+
+class AsyncSpotifyClient:
+    """
+    Use as `async with AsyncSpotifyClient() as client:` inside a running event loop.
+    `policy` is the blocking SpotifyClient whose limiter, retry settings and metrics are shared.
+    """
+
+    def __init__(self, policy: spotify_client.SpotifyClient | None = None):
+        self.policy = policy or spotify_client.get_client()
+        connect_timeout, read_timeout = self.policy.timeout
+        self.http = httpx.AsyncClient(
+            base_url=API_BASE_URL,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=self.policy.pool_size, max_keepalive_connections=self.policy.pool_size),
+            headers={"Accept": "application/json", "Accept-Encoding": "gzip, deflate"},
+        )
+
+    async def __aenter__(self) -> "AsyncSpotifyClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.http.aclose()
+
+    async def request(self, method: str, url: str, token: str, **kwargs) -> httpx.Response:
+        """Sends an authorized request, with the same throttling and retries as SpotifyClient.request()."""
+        headers = kwargs.pop("headers", {})
+        headers["Authorization"] = f"Bearer {token}"
+        policy = self.policy
+
+        for attempt in range(policy.max_retries + 1):
+            waited = policy.limiter.reserve()
+            if waited > 0:
+                await asyncio.sleep(waited)
+            policy._record(requests=1, throttled_seconds=waited)
+
+            try:
+                response = await self.http.request(method, url, headers=headers, **kwargs)
+            except httpx.TransportError as e:
+                if method not in IDEMPOTENT_METHODS or attempt == policy.max_retries:
+                    raise requests.exceptions.ConnectionError(str(e)) from e
+                delay = policy.backoff_delay(attempt)
+                logging.warning(f"{method} {url} failed ({e}). Retrying in {delay:.1f}s.")
+                policy._record(retries=1, backoff_seconds=delay)
+                await asyncio.sleep(delay)
+                continue
+
+            if attempt < policy.max_retries and policy.is_retryable(method, response.status_code):
+                delay = policy.retry_delay(response, attempt)
+                policy._record(retries=1)
+                if response.status_code == 429:
+                    logging.warning(f"Rate limited by Spotify. Pausing requests for {delay:.1f}s.")
+                    policy._record(rate_limited_responses=1)
+                    policy.limiter.pause(delay)
+                else:
+                    logging.warning(f"Spotify returned {response.status_code} for {method} {url}. Retrying in {delay:.1f}s.")
+                    policy._record(server_errors=1, backoff_seconds=delay)
+                    await asyncio.sleep(delay)
+                continue
+
+            if response.is_error:
+                raise requests.exceptions.HTTPError(
+                    f"{response.status_code} Error for url: {response.url}", response=response
+                )
+
+            return response
+
+    async def get(self, url: str, token: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, token, **kwargs)
+
+    async def post(self, url: str, token: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, token, **kwargs)
+
+    # --- Spotify Calls ---
+
+    async def get_playlist_header(self, token: str, playlist_id: str, fields: str = "id,name,snapshot_id") -> dict:
+        """Fetches only the lightweight playlist fields (no track pages)."""
+        response = await self.get(f"/playlists/{playlist_id}", token, params={"fields": fields})
+        return response.json()
+
+    async def get_track_uris(self, token: str, playlist_id: str) -> list:
+        """
+        Returns every track URI in a playlist, in order. After the first page the
+        rest are fetched concurrently, at most `page_workers` at a time.
+        """
+        params = {"fields": TRACK_URI_FIELDS, "limit": MAX_PAGE_SIZE}
+        page = (await self.get(f"/playlists/{playlist_id}/tracks", token, params=params)).json()
+        uris = spotify_client._track_page_uris(page)
+
+        remaining_offsets = range(MAX_PAGE_SIZE, page.get('total') or 0, MAX_PAGE_SIZE)
+        semaphore = asyncio.Semaphore(self.policy.page_workers)
+
+        async def fetch_page(offset):
+            async with semaphore:
+                response = await self.get(f"/playlists/{playlist_id}/tracks", token, params={**params, "offset": offset})
+                return spotify_client._track_page_uris(response.json())
+
+        for page_uris in await asyncio.gather(*(fetch_page(offset) for offset in remaining_offsets)):
+            uris.extend(page_uris)
+
+        logging.info(f"Fetched {len(uris)} tracks from playlist {playlist_id}.")
+        return uris
+
+    async def create_new_playlist(self, token: str, user_id: str, playlist_name: str, description: str) -> str:
+        """Creates a new empty public playlist for a user. Returns its ID."""
+        data = {"name": playlist_name, "public": True, "description": description}
+        response = await self.post(
+            f"/users/{user_id}/playlists", token, headers={"Content-Type": "application/json"}, content=json.dumps(data)
+        )
+        return response.json().get('id')
+
+    async def add_tracks_to_playlist(self, token: str, playlist_id: str, track_uris: list) -> str | None:
+        """Adds tracks 100 at a time, in order. Returns the snapshot_id after the last chunk."""
+        snapshot_id = None
+        for i in range(0, len(track_uris), 100):
+            chunk = track_uris[i:i+100]
+            logging.info(f"Adding {len(chunk)} tracks to playlist {playlist_id}")
+            response = await self.post(
+                f"/playlists/{playlist_id}/tracks", token,
+                headers={"Content-Type": "application/json"}, content=json.dumps({"uris": chunk})
+            )
+            snapshot_id = response.json().get('snapshot_id')
+        return snapshot_id
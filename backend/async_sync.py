@@ -0,0 +1,140 @@
+"""
+Runs hundreds of playlist syncs at once on one asyncio event loop.
+
+Each sync is the same as SyncEngine.sync() (same diff, same snapshot store,
+same source cache), but its Spotify calls go through AsyncSpotifyClient, so a
+sync waiting on Spotify costs a coroutine rather than a thread. The shared rate
+limiter still sets the overall request rate; concurrency just keeps it saturated.
+
+Database work stays synchronous and runs on the loop's thread between awaits.
+Every write is followed by a commit before the next await, so concurrent syncs
+never commit each other's half-finished changes.
+"""
+import time
+import asyncio
+import logging
+from datetime import datetime
+
+import spotify_client
+from models import db
+from async_spotify_client import AsyncSpotifyClient
+from sync_engine import SyncEngine, SyncInputs, SyncResult, compute_diff
+
+
+class AsyncSyncRunner:
+    """Syncs tracked playlists concurrently, at most `concurrency` at a time."""
+
+    def __init__(self, client: AsyncSpotifyClient, concurrency: int = 200):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # One download per source snapshot, however many syncs in this run need it
+        self.source_downloads = {}
+
+    async def _source_uris(self, token: str, playlist_id: str, snapshot_id: str) -> list:
+        """
+        Downloads the source once for every sync in the run that needs it.
+        The shared download uses the token of the sync that started it. If it fails
+        (say that user's token was revoked) it is dropped, and the other syncs retry
+        with their own tokens, so the error only counts against the user it belongs to.
+        """
+        key = (playlist_id, snapshot_id)
+        while True:
+            download = self.source_downloads.get(key)
+            if download is None:
+                download = self.source_downloads[key] = asyncio.ensure_future(self.client.get_track_uris(token, playlist_id))
+                try:
+                    return await download
+                except Exception:
+                    if self.source_downloads.get(key) is download:
+                        del self.source_downloads[key]
+                    raise
+            try:
+                return await download
+            except Exception as e:
+                logging.warning(f"Shared download of source {playlist_id} failed ({e}); retrying with another user's token.")
+                if self.source_downloads.get(key) is download:
+                    del self.source_downloads[key]
+
+    async def sync(self, tracked_playlist, token: str) -> SyncResult:
+        """Syncs one tracked playlist and commits the result."""
+        async with self.semaphore:
+            engine = SyncEngine(token)
+            source_playlist_id = tracked_playlist.source_playlist_id
+            source_header, tracked_header = await asyncio.gather(
+                self.client.get_playlist_header(token, source_playlist_id),
+                self.client.get_playlist_header(token, tracked_playlist.tracked_playlist_id),
+            )
+            source_snapshot_id = source_header.get('snapshot_id')
+            tracked_snapshot_id = tracked_header.get('snapshot_id')
+
+            # Skip the download entirely if neither playlist has changed
+            if engine.snapshots_unchanged(tracked_playlist, source_snapshot_id, tracked_snapshot_id):
+                tracked_playlist.last_synced = datetime.utcnow()
+                db.session.commit()
+                return SyncResult(unchanged=True)
+
+            source_uris = engine.cached_source_uris(source_playlist_id, source_snapshot_id)
+            source_task = None if source_uris is not None else asyncio.ensure_future(
+                self._source_uris(token, source_playlist_id, source_snapshot_id)
+            )
+            snapshot_uris, disliked_uris = engine.load_stored_uris(tracked_playlist)
+            if engine.tracked_unchanged(tracked_playlist, tracked_snapshot_id):
+                current_uris = set(snapshot_uris)
+            else:
+                current_uris = set(await self.client.get_track_uris(token, tracked_playlist.tracked_playlist_id))
+            if source_task is not None:
+                source_uris = list(await source_task)
+
+            inputs = SyncInputs(source_uris, current_uris, snapshot_uris, disliked_uris)
+            diff = compute_diff(inputs.source_uris, inputs.current_uris, inputs.snapshot_uris, inputs.disliked_uris)
+            # End the read transaction (and any cache bookkeeping) before yielding to other syncs
+            db.session.commit()
+
+            if diff.songs_to_add:
+                tracked_snapshot_id = await self.client.add_tracks_to_playlist(
+                    token, tracked_playlist.tracked_playlist_id, diff.songs_to_add
+                )
+
+            if source_task is not None and source_snapshot_id:
+                engine.source_cache.put(source_playlist_id, source_snapshot_id, source_uris)
+            engine.save(tracked_playlist, inputs, diff, source_snapshot_id, tracked_snapshot_id)
+
+            return SyncResult(added=len(diff.songs_to_add), new_dislikes=len(diff.new_dislikes))
+
+    async def sync_safely(self, tracked_playlist, token: str):
+        """Like sync(), but returns the exception instead of raising it."""
+        try:
+            return await self.sync(tracked_playlist, token)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Async sync of playlist {tracked_playlist.id} failed: {e}", exc_info=True)
+            return e
+
+
+async def sync_all(tracked_playlists, tokens: dict, concurrency: int = 200) -> dict:
+    """
+    Syncs every tracked playlist concurrently. `tokens` maps each Spotify user ID to an access token.
+    Returns {tracked playlist ID: SyncResult or the exception it raised}.
+    """
+    started = time.monotonic()
+    # Only this run's calls: the process-wide counters also see other threads' runs
+    with spotify_client.count_requests() as metrics:
+        async with AsyncSpotifyClient() as client:
+            runner = AsyncSyncRunner(client, concurrency)
+            results = await asyncio.gather(*(
+                runner.sync_safely(tracked_playlist, tokens[tracked_playlist.user_id]) for tracked_playlist in tracked_playlists
+            ))
+
+    elapsed = time.monotonic() - started
+    failed = sum(isinstance(result, Exception) for result in results)
+    logging.info(
+        f"Async sync: {len(results)} playlist(s) in {elapsed:.1f}s "
+        f"({len(results) / elapsed if elapsed else 0:.2f} playlists/sec, {failed} failed). "
+        f"{metrics.snapshot()['requests']} API calls."
+    )
+    return {tracked_playlist.id: result for tracked_playlist, result in zip(tracked_playlists, results)}
+
+
+def run_sync_all(tracked_playlists, tokens: dict, concurrency: int = 200) -> dict:
+    """Blocking entry point for sync_all(): runs it on a new event loop in this thread."""
+    return asyncio.run(sync_all(list(tracked_playlists), tokens, concurrency))
@@ -0,0 +1,189 @@
+"""
+Database-backed scheduling for weekly auto-syncs.
+
+Each TrackedPlaylist with auto-sync enabled carries its own `next_sync_at`.
+The sync worker (worker.py) polls for due playlists, claims them with
+SELECT ... FOR UPDATE SKIP LOCKED, pushing `next_sync_at` a week ahead in the
+same transaction, and queues a 'scheduled' SyncJob for each. A due sync is
+therefore queued exactly once, however many worker replicas are polling, and
+schedules survive restarts. The web app only enables and disables schedules.
+
+Each playlist always syncs in the same slot of the week, picked by hashing its
+ID, plus a few minutes of random jitter. Enabling many playlists at once (or a
+deploy) therefore doesn't line their syncs up at the same moment, and on top of
+that at most max_syncs_per_window() scheduled jobs are queued per window. The
+cap is shared by every replica: a worker holds schedule_lock() while it counts
+the window's jobs and queues more.
+"""
+import os
+import random
+import hashlib
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from models import db, TrackedPlaylist, SyncJob
+
+SYNC_INTERVAL = timedelta(weeks=1)
+
+# Slots are offsets from the start of each week (Monday 00:00 UTC)
+WEEK_START = datetime(2024, 1, 1)
+
+# Random delay added to each slot so playlists that hash close together still spread out
+SCHEDULE_JITTER = timedelta(minutes=10)
+
+
+# How many due playlists one process claims per transaction
+CLAIM_BATCH_SIZE = 10
+
+# Arbitrary key for the Postgres advisory lock held while scheduled syncs are queued
+SCHEDULE_LOCK_ID = 7312002
+
+
+def schedule_window() -> timedelta:
+    """
+    At most max_syncs_per_window() scheduled sync jobs are queued in any window
+    (counted by when they were queued, across all workers); the rest stay due
+    and are picked up, oldest first, in the next one.
+    """
+    return timedelta(minutes=int(os.getenv("AUTO_SYNC_WINDOW_MINUTES", "15")))
+
+
+def max_syncs_per_window() -> int:
+    return int(os.getenv("AUTO_SYNC_MAX_PER_WINDOW", "60"))
+
+
+def schedule_offset(tracked_playlist_db_id: int) -> timedelta:
+    """The playlist's fixed slot within the week. Stable across processes and restarts."""
+    digest = hashlib.sha256(str(tracked_playlist_db_id).encode()).digest()
+    seconds = int.from_bytes(digest[:8], 'big') % int(SYNC_INTERVAL.total_seconds())
+    return timedelta(seconds=seconds)
+
+
+def next_sync_time(tracked_playlist_db_id: int, now: datetime | None = None) -> datetime:
+    """The next time the playlist's slot comes round after `now`, plus jitter."""
+    now = now or datetime.utcnow()
+    week_start = now - (now - WEEK_START) % SYNC_INTERVAL
+    slot = week_start + schedule_offset(tracked_playlist_db_id)
+    if slot <= now:
+        slot += SYNC_INTERVAL
+    return slot + random.random() * SCHEDULE_JITTER
+
+
+def enable_auto_sync(tracked_playlist, now: datetime | None = None):
+    """Turns on weekly syncing, starting at the playlist's next slot. Does not commit."""
+    tracked_playlist.auto_sync_enabled = True
+    tracked_playlist.next_sync_at = next_sync_time(tracked_playlist.id, now)
+
+
+def disable_auto_sync(tracked_playlist):
+    """Turns off weekly syncing. Does not commit."""
+    tracked_playlist.auto_sync_enabled = False
+    tracked_playlist.next_sync_at = None
+
+
+@contextmanager
+def schedule_lock():
+    """
+    Held while a worker counts the window's scheduled jobs and queues more, so two
+    replicas can't both see room under the cap and overshoot it together.
+    Yields False, without waiting, if another worker holds it. SQLite setups run a
+    single worker, so there it always yields True.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        yield True
+        return
+
+    # A connection of its own: the lock has to outlive the commits made while it's held
+    with db.engine.connect() as connection:
+        acquired = connection.execute(db.text('SELECT pg_try_advisory_lock(:id)'), {'id': SCHEDULE_LOCK_ID}).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(db.text('SELECT pg_advisory_unlock(:id)'), {'id': SCHEDULE_LOCK_ID})
+
+
+def claim_due_playlists(limit: int = CLAIM_BATCH_SIZE, now: datetime | None = None) -> list:
+    """
+    Claims up to `limit` tracked playlists whose sync is due and reschedules them
+    to their next slot.
+    Rows locked by another process are skipped rather than waited on.
+    Commits, and returns the claimed TrackedPlaylist IDs.
+    """
+    now = now or datetime.utcnow()
+    due_playlists = db.session.execute(
+        db.select(TrackedPlaylist)
+        .where(TrackedPlaylist.auto_sync_enabled == True, TrackedPlaylist.next_sync_at <= now)
+        .order_by(TrackedPlaylist.next_sync_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+
+    for tracked_playlist in due_playlists:
+        tracked_playlist.next_sync_at = next_sync_time(tracked_playlist.id, now)
+
+    claimed_ids = [tracked_playlist.id for tracked_playlist in due_playlists]
+    db.session.commit()
+
+    if claimed_ids:
+        logging.info(f"Claimed {len(claimed_ids)} due auto-sync(s): {claimed_ids}")
+    return claimed_ids
+
+
+def run_due_syncs(run_sync, max_count: int | None = None) -> int:
+    """
+    Claims and runs due syncs batch by batch until none are left, or `max_count` have run.
+    `run_sync` is called with each claimed TrackedPlaylist ID. Returns how many ran.
+    """
+    count = 0
+    while max_count is None or count < max_count:
+        limit = CLAIM_BATCH_SIZE if max_count is None else min(CLAIM_BATCH_SIZE, max_count - count)
+        claimed_ids = claim_due_playlists(limit)
+        if not claimed_ids:
+            return count
+        for tracked_playlist_db_id in claimed_ids:
+            run_sync(tracked_playlist_db_id)
+            count += 1
+    return count
+
+
+# --- Load Report ---
+
+def _bucket_counts(times, start: datetime, bucket: timedelta) -> list:
+    """Counts `times` into consecutive buckets covering one week from `start`."""
+    counts = [0] * int(SYNC_INTERVAL / bucket)
+    for time in times:
+        index = int((time - start) / bucket)
+        if 0 <= index < len(counts):
+            counts[index] += 1
+    return counts
+
+
+def schedule_load(now: datetime | None = None, bucket: timedelta = timedelta(hours=1)) -> dict:
+    """
+    How scheduled syncs are spread over time, for the admin view:
+    'upcoming' counts enabled playlists by next_sync_at over the coming week and
+    'recent' counts scheduled sync jobs started over the past week, per `bucket`, by when
+    a worker picked them up (not when they were queued, which is what the cap counts).
+    """
+    now = now or datetime.utcnow()
+    upcoming_start = now - (now - WEEK_START) % bucket
+    recent_start = upcoming_start - SYNC_INTERVAL + bucket
+
+    upcoming_times = db.session.execute(
+        db.select(TrackedPlaylist.next_sync_at)
+        .where(TrackedPlaylist.auto_sync_enabled == True, TrackedPlaylist.next_sync_at != None)
+    ).scalars().all()
+    recent_times = db.session.execute(
+        db.select(SyncJob.started_at)
+        .where(SyncJob.trigger == 'scheduled', SyncJob.started_at >= recent_start)
+    ).scalars().all()
+
+    return {
+        'bucket': bucket,
+        'upcoming_start': upcoming_start,
+        'upcoming': _bucket_counts(upcoming_times, upcoming_start, bucket),
+        'recent_start': recent_start,
+        'recent': _bucket_counts(recent_times, recent_start, bucket),
+    }
@@ -0,0 +1,138 @@
+"""
+Fan-out sync: syncs many tracked playlists in one pass, grouped by source.
+
+Popular sources are tracked by many users. Synced one by one, each tracked
+playlist fetches the source's header and (if it changed) all of its tracks.
+A batch pass instead fetches each source's header once and its tracks at most
+once, then runs every dependent playlist's diff against that one copy. Only
+the per-user work (the tracked playlist's header and tracks, and the writes)
+is done per playlist, with that playlist owner's token.
+"""
+import math
+import time
+import logging
+from dataclasses import dataclass, field
+
+import spotify_client
+from models import db
+from sync_engine import SyncEngine
+
+
+@dataclass
+class BatchReport:
+    """Throughput and API usage of one batch pass."""
+    playlists: int = 0
+    sources: int = 0
+    failed: int = 0
+    elapsed_seconds: float = 0.0
+    api_calls: int = 0
+    # Calls a playlist-by-playlist pass (without the source cache) would have made on top of this one
+    api_calls_saved: int = 0
+
+    @property
+    def playlists_per_second(self) -> float:
+        return self.playlists / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Synced {self.playlists} playlist(s) from {self.sources} source(s) in {self.elapsed_seconds:.1f}s "
+            f"({self.playlists_per_second:.2f} playlists/sec, {self.failed} failed). "
+            f"{self.api_calls} API calls, {self.api_calls_saved} saved by sharing sources."
+        )
+
+
+@dataclass
+class SourceGroup:
+    """One source playlist and every tracked playlist that follows it."""
+    source_playlist_id: str
+    tracked_playlists: list = field(default_factory=list)
+
+
+def group_by_source(tracked_playlists) -> list:
+    """Groups tracked playlists by source_playlist_id, keeping their order."""
+    groups = {}
+    for tracked_playlist in tracked_playlists:
+        group = groups.setdefault(tracked_playlist.source_playlist_id, SourceGroup(tracked_playlist.source_playlist_id))
+        group.tracked_playlists.append(tracked_playlist)
+    return list(groups.values())
+
+
+def _page_count(track_count: int) -> int:
+    return max(1, math.ceil(track_count / spotify_client.MAX_PAGE_SIZE))
+
+
+def sync_batch(tracked_playlists, get_token) -> tuple:
+    """
+    Syncs every tracked playlist in one pass, grouped by source.
+    `get_token` is called with a Spotify user ID and returns an access token.
+    Each playlist is committed (or rolled back) on its own, so one failure doesn't stop the pass.
+    Returns ({tracked playlist ID: SyncResult or the exception it raised}, BatchReport).
+    """
+    started = time.monotonic()
+    results = {}
+    report = BatchReport()
+
+    # Only this pass's calls: the process-wide counters also see other threads' batches
+    with spotify_client.count_requests() as metrics:
+        for group in group_by_source(tracked_playlists):
+            report.sources += 1
+            report.playlists += len(group.tracked_playlists)
+            try:
+                _sync_group(group, get_token, results, report)
+            except Exception as e:
+                # The source itself couldn't be fetched: every playlist in the group fails
+                db.session.rollback()
+                logging.error(f"Batch sync of source {group.source_playlist_id} failed: {e}", exc_info=True)
+                for tracked_playlist in group.tracked_playlists:
+                    results.setdefault(tracked_playlist.id, e)
+
+    report.failed = sum(isinstance(result, Exception) for result in results.values())
+    report.elapsed_seconds = time.monotonic() - started
+    report.api_calls = metrics.snapshot()['requests']
+    logging.info(f"Batch sync: {report.summary()}")
+    return results, report
+
+
+def _sync_group(group: SourceGroup, get_token, results: dict, report: BatchReport):
+    """Fetches the source once and syncs each of its tracked playlists against it."""
+    source_snapshot_id = _source_snapshot_id(group, get_token)
+    # One header call instead of one per tracked playlist
+    report.api_calls_saved += len(group.tracked_playlists) - 1
+
+    source_uris = None
+
+    for tracked_playlist in group.tracked_playlists:
+        try:
+            engine = SyncEngine(get_token(tracked_playlist.user_id))
+            tracked_snapshot_id = spotify_client.get_playlist_header(engine.token, tracked_playlist.tracked_playlist_id).get('snapshot_id')
+
+            # The source's tracks are only fetched (or read from the source cache) once, and only if needed
+            if not engine.snapshots_unchanged(tracked_playlist, source_snapshot_id, tracked_snapshot_id):
+                if source_uris is None:
+                    source_uris = engine.source_uris(group.source_playlist_id, source_snapshot_id)
+                else:
+                    report.api_calls_saved += _page_count(len(source_uris))
+
+            results[tracked_playlist.id] = engine.sync_snapshots(
+                tracked_playlist, source_snapshot_id, tracked_snapshot_id, source_uris
+            )
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Batch sync of playlist {tracked_playlist.id} failed: {e}", exc_info=True)
+            results[tracked_playlist.id] = e
+
+
+def _source_snapshot_id(group: SourceGroup, get_token) -> str | None:
+    """
+    Fetches the source's snapshot ID with the first group member's token that works, so one
+    user's revoked token or lost access doesn't fail everyone else following the same source.
+    Raises the last error if no member's token can read the source.
+    """
+    error = None
+    for user_id in dict.fromkeys(tracked_playlist.user_id for tracked_playlist in group.tracked_playlists):
+        try:
+            return spotify_client.get_playlist_header(get_token(user_id), group.source_playlist_id).get('snapshot_id')
+        except Exception as e:
+            logging.warning(f"Couldn't read source {group.source_playlist_id} as user {user_id}: {e}")
+            error = e
+    raise error
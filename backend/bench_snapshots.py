@@ -0,0 +1,64 @@
+"""
+Benchmarks snapshot writes: the old full rewrite against the delta writes in snapshot_store.
+
+Run it from the backend directory with:
+    python bench_snapshots.py [track count] [changed tracks]
+
+It uses a throwaway in-memory SQLite database, whatever DATABASE_URL says.
+Writes a full snapshot and then a resync with some tracks changed, both the
+old way (delete every row, then one db.session.add() per track) and with
+RowSnapshotStore.save(), and prints the time and rows per second of each.
+"""
+import os
+import sys
+import time
+
+# Must be set before app is imported; load_dotenv() doesn't override it
+os.environ["DATABASE_URL"] = "sqlite://"
+
+from app import app
+from models import db, User, TrackedPlaylist, SyncedTrack
+from snapshot_store import RowSnapshotStore
+
+
+def legacy_save(tracked_playlist_db_id: int, new_uris: set):
+    """How snapshots were written before: delete them all, then add one row at a time."""
+    db.session.execute(db.delete(SyncedTrack).where(SyncedTrack.tracked_playlist_id == tracked_playlist_db_id))
+    for uri in new_uris:
+        db.session.add(SyncedTrack(track_uri=uri, tracked_playlist_id=tracked_playlist_db_id))
+
+
+def timed(label: str, rows: int, write):
+    started = time.perf_counter()
+    write()
+    db.session.commit()
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<20} {rows / elapsed:>10,.0f} rows/s  ({elapsed * 1000:,.0f} ms)")
+
+
+def main(track_count: int, changed: int):
+    full = {f"spotify:track:{i:022d}" for i in range(track_count)}
+    resynced = set(sorted(full)[changed:]) | {f"spotify:track:new{i:019d}" for i in range(changed)}
+    store = RowSnapshotStore()
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id="bench"))
+        legacy_playlist = TrackedPlaylist(user_id="bench", source_playlist_id="s", tracked_playlist_id="legacy", tracked_playlist_name="legacy")
+        bulk_playlist = TrackedPlaylist(user_id="bench", source_playlist_id="s", tracked_playlist_id="bulk", tracked_playlist_name="bulk")
+        db.session.add_all([legacy_playlist, bulk_playlist])
+        db.session.commit()
+
+        print(f"SQLite, {track_count:,}-track snapshot, {changed:,} tracks changed on resync:")
+        timed("legacy full write", track_count, lambda: legacy_save(legacy_playlist.id, full))
+        timed("legacy resync", track_count, lambda: legacy_save(legacy_playlist.id, resynced))
+        timed("bulk full write", track_count, lambda: store.save(bulk_playlist.id, set(), full))
+        # Counted per snapshot track, like the legacy resync, to compare like with like
+        timed("delta resync", track_count, lambda: store.save(bulk_playlist.id, full, resynced))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+    )
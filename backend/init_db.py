@@ -3,14 +3,17 @@ Database initialization and migration utility script.
 Run this script to create/update database tables.
 """
 import os
+import sys
 from app import app, db
+from migrations import run_migrations, explain_hot_queries
+from snapshot_store import migrate_rows_to_packed
 
 def init_db():
     """Initialize the database tables."""
     with app.app_context():
-        print("Creating database tables...")
-        db.create_all()
-        print("Database tables created successfully!")
+        print("Applying database migrations...")
+        version = run_migrations()
+        print(f"Database schema is at version {version}!")
 
         # Test connection
         try:
@@ -20,5 +23,24 @@ def init_db():
             print(f"Database connection failed: {e}")
             raise
 
+def pack_snapshots():
+    """Converts SyncedTrack snapshot rows into packed PlaylistSnapshot blobs."""
+    with app.app_context():
+        print("Packing track snapshots...")
+        count = migrate_rows_to_packed()
+        print(f"Packed snapshots for {count} tracked playlists.")
+
+def explain():
+    """Checks that the hot queries are served by indexes."""
+    with app.app_context():
+        print("Query plans for hot queries:")
+        if not explain_hot_queries():
+            print("Some hot queries scan a whole table!")
+            sys.exit(1)
+
 if __name__ == '__main__':
     init_db()
+    if '--pack-snapshots' in sys.argv:
+        pack_snapshots()
+    if '--explain' in sys.argv:
+        explain()
@@ -0,0 +1,245 @@
+"""
+Versioned schema migrations.
+
+Each migration runs once, in order, and the highest applied version is kept in
+the 'schema_version' table. Migrations must be idempotent: a fresh database gets
+the whole current schema from migration 1, so later migrations have to cope
+with their changes already being there. They should also use Core statements
+with explicit columns rather than loading ORM objects, as the models may
+already have columns that a later migration adds.
+
+Run them with `python init_db.py` (the Docker image does this before starting gunicorn).
+"""
+import logging
+from datetime import datetime
+
+from auto_sync import SYNC_INTERVAL, next_sync_time
+from models import db, TrackedPlaylist, DislikedSong, SyncedTrack, SyncJob, SourcePlaylistCache, ServerSession
+
+# Arbitrary key for the Postgres advisory lock that stops two pods migrating at once
+MIGRATION_LOCK_ID = 7312001
+
+
+# --- Helpers ---
+
+def _column_names(table: str) -> set:
+    return {column['name'] for column in db.inspect(db.engine).get_columns(table)}
+
+def _add_column(table: str, name: str, column_type: str):
+    """Adds a column unless the table already has it."""
+    if name not in _column_names(table):
+        logging.info(f"Adding column {table}.{name}")
+        # Quoted, as 'user' is a reserved word in Postgres
+        db.session.execute(db.text(f'ALTER TABLE "{table}" ADD COLUMN {name} {column_type}'))
+
+def _create_index(index):
+    """Creates a model-defined Index unless it already exists."""
+    index.create(db.session.connection(), checkfirst=True)
+
+def _delete_duplicates(table: str, columns: str):
+    """Keeps only the oldest row for each combination of `columns`."""
+    result = db.session.execute(db.text(
+        f'DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {columns})'
+    ))
+    if result.rowcount:
+        logging.info(f"Removed {result.rowcount} duplicate rows from {table}")
+
+def _create_table(model):
+    """Creates a model's table (and its indexes) unless it already exists."""
+    model.__table__.create(db.session.connection(), checkfirst=True)
+
+def _index(model, name: str):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+# --- Migrations ---
+
+def create_tables():
+    """Creates any missing tables (the whole schema on a fresh database)."""
+    db.metadata.create_all(db.session.connection())
+
+def add_snapshot_id_columns():
+    _add_column('tracked_playlist', 'source_snapshot_id', 'VARCHAR')
+    _add_column('tracked_playlist', 'tracked_snapshot_id', 'VARCHAR')
+
+def add_hot_path_indexes():
+    """Indexes the per-user and per-playlist lookups and stops duplicate dislikes/snapshot rows."""
+    _delete_duplicates('disliked_song', 'tracked_playlist_id, song_uri')
+    _delete_duplicates('synced_track', 'tracked_playlist_id, track_uri')
+
+    _create_index(_index(TrackedPlaylist, 'ix_tracked_playlist_user_source'))
+    _create_index(_index(DislikedSong, 'uq_disliked_song_playlist_uri'))
+    _create_index(_index(SyncedTrack, 'uq_synced_track_playlist_uri'))
+
+def add_next_sync_at():
+    """
+    Moves auto-sync schedules into the database. Playlists that already had
+    auto-sync on are scheduled a week after their last sync (or right away).
+    """
+    _add_column('tracked_playlist', 'next_sync_at', 'TIMESTAMP')
+    _create_index(_index(TrackedPlaylist, 'ix_tracked_playlist_next_sync_at'))
+
+    # Only select the columns we need: the model may have columns later migrations add
+    now = datetime.utcnow()
+    enabled_playlists = db.session.execute(
+        db.select(TrackedPlaylist.id, TrackedPlaylist.last_synced)
+        .where(TrackedPlaylist.auto_sync_enabled == True, TrackedPlaylist.next_sync_at == None)
+    ).all()
+    for tracked_playlist_db_id, last_synced in enabled_playlists:
+        next_sync_at = max(now, (last_synced or now) + SYNC_INTERVAL)
+        db.session.execute(
+            db.update(TrackedPlaylist)
+            .where(TrackedPlaylist.id == tracked_playlist_db_id)
+            .values(next_sync_at=next_sync_at, job_id=None)
+        )
+
+def add_sync_job_table():
+    _create_table(SyncJob)
+
+def spread_auto_sync_schedules():
+    """Moves every enabled playlist's next sync onto its hashed slot of the week."""
+    now = datetime.utcnow()
+    enabled_playlist_ids = db.session.execute(
+        db.select(TrackedPlaylist.id).where(TrackedPlaylist.auto_sync_enabled == True)
+    ).scalars().all()
+    for tracked_playlist_db_id in enabled_playlist_ids:
+        db.session.execute(
+            db.update(TrackedPlaylist)
+            .where(TrackedPlaylist.id == tracked_playlist_db_id)
+            .values(next_sync_at=next_sync_time(tracked_playlist_db_id, now))
+        )
+
+def add_source_playlist_cache_table():
+    _create_table(SourcePlaylistCache)
+
+def add_copy_progress_columns():
+    _add_column('tracked_playlist', 'copy_total', 'INTEGER')
+    _add_column('tracked_playlist', 'copy_done', 'INTEGER')
+    _add_column('tracked_playlist', 'copy_uris', 'BYTEA' if db.engine.dialect.name == 'postgresql' else 'BLOB')
+
+def add_server_sessions():
+    """Moves sessions and access tokens server-side."""
+    _create_table(ServerSession)
+    _add_column('user', 'access_token', 'VARCHAR')
+    _add_column('user', 'access_token_expires_at', 'TIMESTAMP')
+
+def add_sync_job_heartbeat():
+    _add_column('sync_job', 'heartbeat_at', 'TIMESTAMP')
+
+def add_one_active_job_per_playlist():
+    """Finishes all but the oldest active job of each playlist, then stops new duplicates."""
+    active = "status IN ('queued', 'running')"
+    result = db.session.execute(db.text(
+        f"UPDATE sync_job SET status = 'succeeded', result = 'Merged into an earlier job.', finished_at = :now "
+        f"WHERE {active} AND id NOT IN (SELECT MIN(id) FROM sync_job WHERE {active} GROUP BY tracked_playlist_id)"
+    ), {'now': datetime.utcnow()})
+    if result.rowcount:
+        logging.info(f"Finished {result.rowcount} duplicate active sync jobs")
+    _create_index(_index(SyncJob, 'uq_sync_job_active_playlist'))
+
+
+MIGRATIONS = [
+    (1, "Create tables", create_tables),
+    (2, "Add snapshot ID columns to tracked_playlist", add_snapshot_id_columns),
+    (3, "Add indexes and uniqueness constraints for hot queries", add_hot_path_indexes),
+    (4, "Schedule auto-syncs in the database", add_next_sync_at),
+    (5, "Add the sync job queue", add_sync_job_table),
+    (6, "Spread auto-syncs across the week", spread_auto_sync_schedules),
+    (7, "Add the shared source playlist cache", add_source_playlist_cache_table),
+    (8, "Track the progress of initial playlist copies", add_copy_progress_columns),
+    (9, "Store sessions and access tokens in the database", add_server_sessions),
+    (10, "Add a heartbeat to running sync jobs", add_sync_job_heartbeat),
+    (11, "Allow one active sync job per playlist", add_one_active_job_per_playlist),
+]
+
+
+# --- Runner ---
+
+def get_schema_version() -> int:
+    db.session.execute(db.text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    return db.session.execute(db.text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+def run_migrations() -> int:
+    """Applies every pending migration, each in its own transaction. Returns the new schema version."""
+    if db.engine.dialect.name != 'postgresql':
+        return _apply_migrations()
+
+    # The lock belongs to the connection that took it, so it's held on one of its own for the
+    # whole run: the session's connection goes back to the pool at every commit
+    with db.engine.connect() as lock_connection:
+        lock_connection.execute(db.text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+        try:
+            return _apply_migrations()
+        finally:
+            lock_connection.execute(db.text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
+
+def _apply_migrations() -> int:
+    try:
+        current_version = get_schema_version()
+        db.session.commit()
+
+        for version, description, migrate in MIGRATIONS:
+            if version <= current_version:
+                continue
+            logging.info(f"Applying migration {version}: {description}")
+            migrate()
+            db.session.execute(db.text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+            db.session.commit()
+            current_version = version
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return current_version
+
+
+# --- Query Plan Check ---
+
+def hot_queries() -> dict:
+    """The queries run on (almost) every request, keyed by where they're used."""
+    return {
+        '/profile: playlists for a user': db.select(TrackedPlaylist).where(TrackedPlaylist.user_id == 'user'),
+        '/track: already tracking source?': db.select(TrackedPlaylist).where(
+            TrackedPlaylist.user_id == 'user', TrackedPlaylist.source_playlist_id == 'source'
+        ),
+        '/sync: disliked songs': db.select(DislikedSong.song_uri).where(DislikedSong.tracked_playlist_id == 1),
+        '/sync: snapshot': db.select(SyncedTrack.track_uri).where(SyncedTrack.tracked_playlist_id == 1),
+        '/sync: active job for a playlist': db.select(SyncJob).where(
+            SyncJob.tracked_playlist_id == 1, SyncJob.status.in_(['queued', 'running'])
+        ),
+        'worker: claim queued jobs': db.select(SyncJob).where(SyncJob.status == 'queued').order_by(SyncJob.created_at).limit(10),
+        'worker: claim due auto-syncs': db.select(TrackedPlaylist).where(
+            TrackedPlaylist.auto_sync_enabled == True, TrackedPlaylist.next_sync_at <= '2024-01-01 00:00:00'
+        ).order_by(TrackedPlaylist.next_sync_at).limit(10),
+    }
+
+def explain_hot_queries() -> bool:
+    """
+    Prints the query plan for each hot query and flags any that scan a whole table.
+    On Postgres sequential scans are disabled for the check, since the planner
+    prefers them on small tables even when a usable index exists.
+    Returns True if every query can use an index.
+    """
+    dialect = db.engine.dialect.name
+    all_indexed = True
+
+    if dialect == 'postgresql':
+        db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+
+    for name, query in hot_queries().items():
+        sql = str(query.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        if dialect == 'sqlite':
+            rows = db.session.execute(db.text(f'EXPLAIN QUERY PLAN {sql}')).all()
+            plan = [row[-1] for row in rows]
+            full_scan = any(step.startswith('SCAN') and 'INDEX' not in step for step in plan)
+        else:
+            plan = [row[0] for row in db.session.execute(db.text(f'EXPLAIN {sql}')).all()]
+            full_scan = any('Seq Scan' in step for step in plan)
+
+        all_indexed = all_indexed and not full_scan
+        print(f"{'FULL SCAN' if full_scan else 'indexed':>9}  {name}")
+        for step in plan:
+            print(f"           {step}")
+
+    db.session.rollback()
+    return all_indexed
@@ -1,6 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import String, ForeignKey
+from sqlalchemy import String, ForeignKey, LargeBinary, Index, text
 from typing import List
 from datetime import datetime
 
@@ -23,6 +23,10 @@ class User(db.Model):
     id: Mapped[str] = mapped_column(String, primary_key=True)
     refresh_token: Mapped[str | None] = mapped_column(String)
 
+    # The user's current access token, shared by every web pod and worker (see token_cache.py)
+    access_token: Mapped[str | None] = mapped_column(String, nullable=True)
+    access_token_expires_at: Mapped[datetime | None] = mapped_column(nullable=True)
+
     # Establishes a one-to-many relationship with TrackedPlaylist
     #  A user can have many tracked playlists.
     tracked_playlists: Mapped[List["TrackedPlaylist"]] = relationship(back_populates="user")
@@ -30,6 +34,11 @@ class User(db.Model):
 class TrackedPlaylist(db.Model):
     """Represents a playlist that a user is tracking."""
     __tablename__ = 'tracked_playlist'
+    __table_args__ = (
+        # Serves both "all playlists for a user" (leading column) and the
+        #  "already tracking this source?" check in /track
+        Index('ix_tracked_playlist_user_source', 'user_id', 'source_playlist_id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
 
@@ -45,9 +54,27 @@ class TrackedPlaylist(db.Model):
     # The timestamp of the last successful sync
     last_synced: Mapped[datetime | None] = mapped_column(nullable=True)
 
+    # Spotify snapshot IDs seen at the last successful sync. If neither has
+    #  moved since, the sync can finish without downloading any tracks.
+    source_snapshot_id: Mapped[str | None] = mapped_column(String, nullable=True)
+    tracked_snapshot_id: Mapped[str | None] = mapped_column(String, nullable=True)
+
     auto_sync_enabled: Mapped[bool] = mapped_column(default=False)
+
+    # When the next weekly auto-sync is due (see auto_sync.py)
+    next_sync_at: Mapped[datetime | None] = mapped_column(nullable=True, index=True)
+
+    # No longer used: auto-sync jobs used to live in each process's in-memory APScheduler
     job_id: Mapped[str | None] = mapped_column(String)
 
+    # Progress of the initial copy from the source, which runs as a 'copy' SyncJob (see playlist_copy.py).
+    #  Both NULL for playlists copied before copies moved to the worker.
+    copy_total: Mapped[int | None] = mapped_column(nullable=True)
+    copy_done: Mapped[int | None] = mapped_column(nullable=True)
+
+    # The packed URIs being copied, kept until the copy finishes so a resumed copy adds exactly the rest
+    copy_uris: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
+
     # Foreign key to link back to the user who owns this tracked playlist
     user_id: Mapped[str] = mapped_column(ForeignKey("user.id"))
 
@@ -57,9 +84,23 @@ class TrackedPlaylist(db.Model):
     # A tracked playlist can have many disliked songs
     disliked_songs: Mapped[List["DislikedSong"]] = relationship(cascade="all, delete-orphan")
 
+    # The packed track snapshot from the last sync (only used with SNAPSHOT_STORAGE=packed)
+    packed_snapshot: Mapped["PlaylistSnapshot | None"] = relationship(cascade="all, delete-orphan")
+
+    # Queued and finished syncs for this playlist
+    sync_jobs: Mapped[List["SyncJob"]] = relationship(cascade="all, delete-orphan")
+
+    @property
+    def copy_in_progress(self) -> bool:
+        """True until the initial copy has added every track (including while it's failed and waiting to be resumed)."""
+        return self.copy_done is not None and (self.copy_total is None or self.copy_done < self.copy_total)
+
 class DislikedSong(db.Model):
     """Represents a song a user has removed from a tracked playlist."""
     __tablename__ = 'disliked_song'
+    __table_args__ = (
+        Index('uq_disliked_song_playlist_uri', 'tracked_playlist_id', 'song_uri', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
 
@@ -72,9 +113,100 @@ class DislikedSong(db.Model):
 class SyncedTrack(db.Model):
     """Stores a snapshot of track URIs for a playlist at the last successful sync."""
     __tablename__ = 'synced_track'
+    __table_args__ = (
+        Index('uq_synced_track_playlist_uri', 'tracked_playlist_id', 'track_uri', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     track_uri = db.Column(db.String, nullable=False)
     tracked_playlist_id = db.Column(db.Integer, db.ForeignKey('tracked_playlist.id'), nullable=False, index=True)
 
     def __repr__(self):
-        return f'<SyncedTrack {self.track_uri} for playlist {self.tracked_playlist_id}>'
\ No newline at end of file
+        return f'<SyncedTrack {self.track_uri} for playlist {self.tracked_playlist_id}>'
+
+class PlaylistSnapshot(db.Model):
+    """Stores the snapshot of a tracked playlist as a single compressed blob of track IDs."""
+    __tablename__ = 'playlist_snapshot'
+
+    # One snapshot per tracked playlist
+    tracked_playlist_id: Mapped[int] = mapped_column(ForeignKey("tracked_playlist.id"), primary_key=True)
+
+    # Layout of 'data'; see snapshot_store.py
+    format_version: Mapped[int] = mapped_column(nullable=False)
+    track_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    updated_at: Mapped[datetime | None] = mapped_column(nullable=True)
+
+    def __repr__(self):
+        return f'<PlaylistSnapshot v{self.format_version} ({self.track_count} tracks) for playlist {self.tracked_playlist_id}>'
+
+class SyncJob(db.Model):
+    """A sync of one tracked playlist, queued by the web app and run by the sync worker."""
+    __tablename__ = 'sync_job'
+    __table_args__ = (
+        # The worker claims the oldest queued jobs first
+        Index('ix_sync_job_status_created', 'status', 'created_at'),
+        # At most one queued or running job per playlist, however enqueue_sync calls race
+        Index(
+            'uq_sync_job_active_playlist', 'tracked_playlist_id', unique=True,
+            postgresql_where=text("status IN ('queued', 'running')"),
+            sqlite_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    tracked_playlist_id: Mapped[int] = mapped_column(ForeignKey("tracked_playlist.id"), index=True)
+
+    # 'manual' (the Sync button), 'scheduled' (weekly auto-sync) or 'copy' (the initial copy after /track)
+    trigger: Mapped[str] = mapped_column(String, nullable=False, default='manual')
+
+    # 'queued' -> 'running' -> 'succeeded' or 'failed'
+    status: Mapped[str] = mapped_column(String, nullable=False, default='queued')
+
+    # A short human-readable outcome, or the error if the sync failed
+    result: Mapped[str | None] = mapped_column(String, nullable=True)
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    started_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    # Refreshed by the worker while the job runs, so a long batch isn't mistaken for an abandoned one
+    heartbeat_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    finished_at: Mapped[datetime | None] = mapped_column(nullable=True)
+
+    def __repr__(self):
+        return f'<SyncJob {self.id} ({self.status}) for playlist {self.tracked_playlist_id}>'
+
+class SourcePlaylistCache(db.Model):
+    """A cached copy of a source playlist's track URIs at one snapshot, shared by every user and pod."""
+    __tablename__ = 'source_playlist_cache'
+    __table_args__ = (
+        # Eviction deletes the least recently used entries first
+        Index('ix_source_playlist_cache_last_used_at', 'last_used_at'),
+    )
+
+    playlist_id: Mapped[str] = mapped_column(String, primary_key=True)
+    snapshot_id: Mapped[str] = mapped_column(String, primary_key=True)
+
+    # zlib-compressed, newline-separated URIs in playlist order; see source_cache.py
+    track_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    last_used_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<SourcePlaylistCache {self.playlist_id}@{self.snapshot_id} ({self.track_count} tracks)>'
+
+class ServerSession(db.Model):
+    """A browser session's data, kept server-side; the cookie only holds the ID (see session_store.py)."""
+    __tablename__ = 'server_session'
+
+    # Random and unguessable, so knowing it is what identifies the browser
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+
+    # The session dict, serialized like Flask's own cookie sessions
+    data: Mapped[str] = mapped_column(String, nullable=False)
+
+    expires_at: Mapped[datetime] = mapped_column(nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<ServerSession expiring {self.expires_at}>'
@@ -0,0 +1,76 @@
+"""
+The initial copy of a source playlist into a newly tracked playlist.
+
+/track only creates the empty playlist and queues a 'copy' SyncJob, so a
+10k-track source no longer has to fit in one web request. The worker then:
+ 1. downloads the source once and stores the URIs on the TrackedPlaylist,
+ 2. adds them 100 at a time (through the shared, rate-limited client),
+    committing copy_done after every chunk so the profile page can show progress,
+ 3. saves the sync snapshot, as a first sync would.
+
+A copy that dies part-way (a failed job, or a worker killed mid-chunk) resumes
+from the playlist's actual track count, not from copy_done: a chunk Spotify
+accepted just before the crash is counted even though its commit never
+happened, so no track is added twice. Chunks are added in order, one at a time,
+to keep the source's order and make that count an exact resume point.
+"""
+import logging
+from datetime import datetime
+
+import spotify_client
+from models import db
+from snapshot_store import get_snapshot_store
+from source_cache import encode_uris, decode_uris
+from sync_engine import SyncEngine
+
+# Spotify's limit for one add request
+CHUNK_SIZE = 100
+
+
+def start_copy(tracked_playlist):
+    """Marks a new tracked playlist as waiting for its initial copy. Does not commit."""
+    tracked_playlist.copy_done = 0
+    tracked_playlist.copy_total = None
+    tracked_playlist.copy_uris = None
+
+
+def run_copy(tracked_playlist, token: str) -> str:
+    """Copies (or finishes copying) the source into the tracked playlist and commits. Returns a summary."""
+    if tracked_playlist.copy_uris is None:
+        _download_source(tracked_playlist, token)
+    track_uris = decode_uris(tracked_playlist.copy_uris)
+
+    # Resume from what the playlist actually holds; only the copy writes to it until it's done
+    header = spotify_client.get_playlist_header(token, tracked_playlist.tracked_playlist_id, fields="snapshot_id,tracks(total)")
+    tracked_snapshot_id = header.get('snapshot_id')
+    already_copied = min(header['tracks']['total'], len(track_uris))
+    if already_copied:
+        logging.info(f"Resuming the copy into '{tracked_playlist.tracked_playlist_name}' at track {already_copied} of {len(track_uris)}.")
+    tracked_playlist.copy_done = already_copied
+    db.session.commit()
+
+    for i in range(already_copied, len(track_uris), CHUNK_SIZE):
+        chunk = track_uris[i:i+CHUNK_SIZE]
+        tracked_snapshot_id = spotify_client.add_tracks_to_playlist(token, tracked_playlist.tracked_playlist_id, chunk)
+        tracked_playlist.copy_done = i + len(chunk)
+        db.session.commit()
+
+    get_snapshot_store().save(tracked_playlist.id, set(), set(track_uris))
+    tracked_playlist.tracked_snapshot_id = tracked_snapshot_id
+    tracked_playlist.last_synced = datetime.utcnow()
+    tracked_playlist.copy_uris = None
+    db.session.commit()
+
+    logging.info(f"Copied {len(track_uris)} tracks into '{tracked_playlist.tracked_playlist_name}'.")
+    return f"Copied {len(track_uris)} songs."
+
+
+def _download_source(tracked_playlist, token: str):
+    """Fetches the source's tracks and stores them (and its snapshot ID) for the copy, then commits."""
+    source_snapshot_id = spotify_client.get_playlist_header(token, tracked_playlist.source_playlist_id).get('snapshot_id')
+    track_uris = SyncEngine(token).source_uris(tracked_playlist.source_playlist_id, source_snapshot_id)
+
+    tracked_playlist.copy_uris = encode_uris(track_uris)
+    tracked_playlist.copy_total = len(track_uris)
+    tracked_playlist.source_snapshot_id = source_snapshot_id
+    db.session.commit()
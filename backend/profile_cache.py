@@ -0,0 +1,241 @@
+"""
+A short-lived cache of the Spotify metadata shown on /profile.
+
+/profile is the landing page, and it used to call Spotify for the user's
+playlists and every source playlist on each render. This cache keeps those
+responses per process with stale-while-revalidate: a fresh entry is returned
+as-is, a stale one is returned immediately while a background thread fetches
+a new copy, and only an expired (or missing) entry is fetched inline.
+A warm render therefore makes no Spotify calls.
+
+The edit page's track pages are cached here too, briefly and without a stale
+period, so scrolling back and forth (or reopening the page) doesn't refetch them.
+
+The cache is per process, so invalidate_*() only clears this process's copy.
+For the user's own changes (tracking, deleting, removing songs) the app also
+records when they happened in the user's session, which every pod shares, and
+passes it in as `changed_at`: an entry fetched before then is refetched, in
+whichever process it was cached. Changes made elsewhere (a sync by the worker,
+edits in the Spotify app, another browser) show up when the entry expires.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+import spotify_client
+
+# (fresh for, then served stale for) in seconds
+PLAYLISTS_TTL = (60, 600)
+SOURCE_TTL = (600, 86400)
+# Never served stale: a sync or removal should show up within a minute
+TRACKS_TTL = (60, 0)
+
+MAX_ENTRIES = 2000
+# Beyond this many pages of the user's playlists (50 each), missing tracked playlists are checked one by one
+MAX_PLAYLIST_PAGES = 20
+SOURCE_FETCH_WORKERS = 8
+SOURCE_FIELDS = "id,name,images,owner(id,display_name)"
+
+
+class MetadataCache:
+    """A thread-safe, size-bounded stale-while-revalidate cache."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch, ttl: tuple, changed_at: float | None = None) -> tuple:
+        """
+        Returns (value, fetched_at) for `key`, calling `fetch()` to fill or refresh it.
+        `ttl` is (fresh seconds, stale seconds). An entry fetched before `changed_at` is ignored.
+        """
+        return self.lookup(key, fetch, ttl, changed_at) or self.put(key, fetch())
+
+    def lookup(self, key, fetch, ttl: tuple, changed_at: float | None = None) -> tuple | None:
+        """
+        Like get(), but returns None instead of fetching inline when `key` is missing or expired.
+        A stale entry is still returned, and refreshed in the background.
+        """
+        fresh_for, stale_for = ttl
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (changed_at is not None and entry[1] < changed_at):
+                return None
+            self.entries.move_to_end(key)
+            age = time.time() - entry[1]
+            if age >= fresh_for + stale_for:
+                return None
+            if age >= fresh_for and key not in self.refreshing:
+                self.refreshing.add(key)
+                threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+            return entry
+
+    def put(self, key, value) -> tuple:
+        entry = (value, time.time())
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        """Drops every entry whose key satisfies `predicate`."""
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def _refresh(self, key, fetch):
+        try:
+            self.put(key, fetch())
+        except Exception as e:
+            # Keep serving the stale copy; the next render past its expiry will fetch inline
+            logging.warning(f"Background refresh of {key} failed: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+
+_cache = MetadataCache()
+
+
+@dataclass
+class PlaylistListing:
+    """The user's playlists, as far as they were fetched."""
+    items: list
+    # True if every page was fetched, so a playlist missing from `items` really is gone
+    complete: bool
+
+
+def _fetch_user_playlists(token: str, wanted_ids: set) -> PlaylistListing:
+    """
+    Pages through the user's playlists until every ID in `wanted_ids` has been seen,
+    or MAX_PLAYLIST_PAGES pages have been read, or there are no more pages.
+    """
+    items = []
+    remaining_ids = set(wanted_ids)
+    for page_number, page in enumerate(spotify_client.iter_user_playlist_pages(token), start=1):
+        items.extend(page['items'])
+        remaining_ids -= {playlist['id'] for playlist in page['items']}
+        if not page.get('next'):
+            return PlaylistListing(items, complete=True)
+        if not remaining_ids or page_number >= MAX_PLAYLIST_PAGES:
+            return PlaylistListing(items, complete=False)
+    return PlaylistListing(items, complete=True)
+
+
+def user_playlists(token: str, user_id: str, wanted_ids=(), changed_at: float | None = None) -> tuple:
+    """
+    Returns (PlaylistListing, when it was fetched as a time.time() timestamp).
+    Paging stops early once every ID in `wanted_ids` (the user's tracked playlists) has been found.
+    A listing fetched before `changed_at` (when the user last created or deleted a playlist) is refetched.
+    """
+    wanted_ids = frozenset(wanted_ids)
+    return _cache.get(('playlists', user_id), lambda: _fetch_user_playlists(token, wanted_ids), PLAYLISTS_TTL, changed_at)
+
+
+def followed_playlists(token: str, user_id: str, playlist_ids) -> dict:
+    """
+    Checks in parallel whether the user still follows each playlist.
+    Returns {playlist ID: True/False}, or None for a playlist whose check failed.
+    """
+    def check(playlist_id):
+        try:
+            return spotify_client.user_follows_playlist(token, playlist_id, user_id)
+        except Exception as e:
+            logging.error(f"Could not check whether {user_id} follows playlist {playlist_id}: {e}")
+            return None
+
+    playlist_ids = list(playlist_ids)
+    if not playlist_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(SOURCE_FETCH_WORKERS, len(playlist_ids))) as executor:
+        return dict(zip(playlist_ids, executor.map(check, playlist_ids)))
+
+
+def invalidate_user_playlists(user_id: str):
+    """Call after creating or deleting one of the user's playlists."""
+    _cache.invalidate(('playlists', user_id))
+
+
+def playlists_metadata(token: str, playlist_ids) -> list:
+    """
+    Name, cover and owner of each playlist. Cached ones are served from the
+    cache and the rest are fetched in parallel. Playlists that can't be fetched are skipped.
+    """
+    playlists = {}
+    missing_ids = []
+    for playlist_id in playlist_ids:
+        entry = _cache.lookup(
+            ('source', playlist_id),
+            lambda playlist_id=playlist_id: spotify_client.get_playlist_header(token, playlist_id, fields=SOURCE_FIELDS),
+            SOURCE_TTL
+        )
+        if entry is None:
+            missing_ids.append(playlist_id)
+        else:
+            playlists[playlist_id] = entry[0]
+
+    def fetch(playlist_id):
+        try:
+            return _cache.put(('source', playlist_id), spotify_client.get_playlist_header(token, playlist_id, fields=SOURCE_FIELDS))[0]
+        except Exception as e:
+            logging.error(f"Could not fetch source playlist {playlist_id}: {e}")
+            return None
+
+    if missing_ids:
+        with ThreadPoolExecutor(max_workers=min(SOURCE_FETCH_WORKERS, len(missing_ids))) as executor:
+            for playlist_id, playlist in zip(missing_ids, executor.map(fetch, missing_ids)):
+                if playlist is not None:
+                    playlists[playlist_id] = playlist
+
+    return [playlists[playlist_id] for playlist_id in playlist_ids if playlist_id in playlists]
+
+
+def _listing_track(item: dict) -> dict | None:
+    """Flattens one playlist item to what the edit page shows. None for removed or unavailable tracks."""
+    track = item.get('track')
+    if not track or not track.get('uri'):
+        return None
+    images = (track.get('album') or {}).get('images') or []
+    return {
+        'uri': track['uri'],
+        'name': track.get('name') or track['uri'],
+        'artist': ', '.join(artist['name'] for artist in track.get('artists') or [] if artist.get('name')),
+        # Spotify lists album art largest first; the smallest is plenty for a thumbnail
+        'image_url': images[-1]['url'] if images else None,
+    }
+
+
+def playlist_tracks_page(token: str, playlist_id: str, offset: int = 0, limit: int = spotify_client.MAX_PAGE_SIZE,
+                         changed_at: float | None = None) -> dict:
+    """
+    One page of a playlist's tracks for the edit page:
+    {'tracks': [{'uri', 'name', 'artist', 'image_url'}], 'next_offset': int or None, 'total': int}.
+    A page fetched before `changed_at` (when the user last removed tracks) is refetched.
+    """
+    def fetch():
+        page = spotify_client.get_track_listing_page(token, playlist_id, offset, limit)
+        total = page.get('total') or 0
+        return {
+            'tracks': [track for track in map(_listing_track, page['items']) if track],
+            'next_offset': offset + limit if offset + limit < total else None,
+            'total': total,
+        }
+
+    value, _ = _cache.get(('tracks', playlist_id, offset, limit), fetch, TRACKS_TTL, changed_at)
+    return value
+
+
+def invalidate_playlist_tracks(playlist_id: str):
+    """Call after removing tracks from a playlist, so the edit page shows the change."""
+    _cache.invalidate_matching(lambda key: key[:2] == ('tracks', playlist_id))
@@ -0,0 +1,206 @@
+"""
+Server-side Flask sessions.
+
+Flask's default session is the whole session dict in a signed cookie, so every
+request carried (and every response re-signed) the user's token info, flashes
+and undo data. With this interface the cookie holds only a random session ID,
+and the data lives in a store picked with SESSION_STORE:
+ - 'database' (default): ServerSession rows, shared by every web pod.
+ - 'memory': a dict in this process, for local development with one process.
+ - 'cookie': Flask's default signed cookie sessions.
+
+Access tokens aren't kept in the session at all any more; see token_cache.py.
+"""
+import os
+import secrets
+import threading
+from datetime import datetime
+
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.datastructures import CallbackDict
+
+from models import db, ServerSession
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """A session dict that remembers its ID and whether it was changed."""
+
+    def __init__(self, initial=None, sid: str | None = None, new: bool = False):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Set by regenerate(): the stored session to delete once this one is saved under its new ID
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the session to a fresh ID, so an ID planted or seen before login can't be used after it."""
+        if not self.new and self.replaced_sid is None:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+# --- Stores ---
+
+class MemorySessionStore:
+    """Keeps sessions in this process. Sessions are lost on restart and not shared between pods."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def load(self, sid: str) -> str | None:
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at <= datetime.utcnow():
+                del self.sessions[sid]
+                return None
+            return data
+
+    def save(self, sid: str, data: str, expires_at: datetime):
+        with self.lock:
+            self.sessions[sid] = (data, expires_at)
+
+    def delete(self, sid: str):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+
+class DatabaseSessionStore:
+    """
+    Keeps sessions in the server_session table, shared by every pod.
+    Uses its own connection rather than the request's session, so saving the
+    session never commits (or is rolled back with) a view's half-finished work.
+    """
+
+    def load(self, sid: str) -> str | None:
+        with db.engine.connect() as connection:
+            return connection.execute(
+                db.select(ServerSession.data)
+                .where(ServerSession.id == sid, ServerSession.expires_at > datetime.utcnow())
+            ).scalar()
+
+    def save(self, sid: str, data: str, expires_at: datetime):
+        dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+        statement = dialect.insert(ServerSession).values(id=sid, data=data, expires_at=expires_at)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ServerSession.id],
+            set_={'data': statement.excluded.data, 'expires_at': statement.excluded.expires_at}
+        )
+        with db.engine.begin() as connection:
+            connection.execute(statement)
+
+    def delete(self, sid: str):
+        with db.engine.begin() as connection:
+            connection.execute(db.delete(ServerSession).where(ServerSession.id == sid))
+
+    def delete_expired(self):
+        with db.engine.begin() as connection:
+            connection.execute(db.delete(ServerSession).where(ServerSession.expires_at <= datetime.utcnow()))
+
+
+# The in-process store only works if every request in the process shares it
+_memory_store = None
+_memory_store_lock = threading.Lock()
+
+
+def get_memory_store() -> MemorySessionStore:
+    """Returns this process's MemorySessionStore, creating it on first use."""
+    global _memory_store
+    with _memory_store_lock:
+        if _memory_store is None:
+            _memory_store = MemorySessionStore()
+        return _memory_store
+
+
+SESSION_STORES = {
+    'memory': get_memory_store,
+    'database': DatabaseSessionStore,
+}
+
+
+# --- Session Interface ---
+
+class ServerSideSessionInterface(SessionInterface):
+    """Stores session data in `store`; the session cookie is just an opaque ID."""
+
+    serializer = SecureCookieSessionInterface.serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request) -> ServerSideSession:
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSideSession(self.serializer.loads(data), sid=sid)
+        # No cookie, or an expired or unknown session: start a new one (only stored once something is put in it)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session: ServerSideSession, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced_sid is not None:
+            self.store.delete(session.replaced_sid)
+
+        if not session:
+            if session.modified and not session.new:
+                # The session was cleared (e.g. logout): forget it on both sides
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified and not self.should_set_cookie(app, session):
+            return
+
+        # Permanent or not, stored sessions expire; a browser session just loses its cookie sooner.
+        # Unchanged sessions are only rewritten to push back the expiry of a permanent session.
+        expires_at = datetime.utcnow() + app.permanent_session_lifetime
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), expires_at)
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def regenerate_session(session):
+    """
+    Gives the current session a new ID (and cookie), dropping the old one. Call it whenever
+    the signed-in user changes. Cookie sessions have no ID to replace, so they're left alone.
+    """
+    if isinstance(session, ServerSideSession):
+        session.regenerate()
+
+
+def delete_expired_sessions():
+    """Deletes expired sessions from the database. The sync worker calls this now and then."""
+    if os.getenv("SESSION_STORE", "database") == 'database':
+        DatabaseSessionStore().delete_expired()
+
+
+def init_sessions(app):
+    """Installs the session interface selected by the SESSION_STORE environment variable."""
+    backend = os.getenv("SESSION_STORE", "database")
+    if backend == 'cookie':
+        return
+    if backend not in SESSION_STORES:
+        raise ValueError(f"Unknown SESSION_STORE '{backend}'. Expected one of: cookie, {', '.join(SESSION_STORES)}")
+    app.session_interface = ServerSideSessionInterface(SESSION_STORES[backend]())
@@ -0,0 +1,184 @@
+"""
+Storage for the per-playlist track snapshot taken at the last successful sync.
+
+Two interchangeable formats are supported, picked with SNAPSHOT_STORAGE:
+ - 'rows' (default): one SyncedTrack row per track URI.
+ - 'packed': one PlaylistSnapshot row per tracked playlist holding a compressed
+   blob of 16-byte track IDs. It loads into a set with a single read.
+
+The packed store falls back to SyncedTrack rows for playlists that haven't been
+converted yet and removes those rows the first time it saves, so switching
+formats is safe without a migration; migrate_rows_to_packed() converts everything up front.
+"""
+import os
+import zlib
+import struct
+import logging
+from datetime import datetime
+from typing import Iterable
+
+from models import db, SyncedTrack, PlaylistSnapshot
+
+# Keeps DELETE ... IN (...) lists well under SQLite's and Postgres' parameter limits
+DELETE_CHUNK_SIZE = 500
+
+# --- Packed Format ---
+# Version 1 blob (zlib-compressed):
+#   4-byte big-endian count N, N x 16-byte track IDs, then any URIs that aren't
+#   plain 'spotify:track:<base62>' (local files, episodes) as UTF-8, newline-separated.
+
+PACKED_FORMAT_VERSION = 1
+TRACK_URI_PREFIX = "spotify:track:"
+BASE62_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+BASE62_INDEX = {char: i for i, char in enumerate(BASE62_ALPHABET)}
+MAX_TRACK_ID = (1 << 128) - 1
+
+
+def _track_id_to_bytes(track_id: str) -> bytes | None:
+    """Decodes a 22-char base62 track ID to 16 bytes, or None if it can't round-trip."""
+    if len(track_id) != 22:
+        return None
+    value = 0
+    for char in track_id:
+        digit = BASE62_INDEX.get(char)
+        if digit is None:
+            return None
+        value = value * 62 + digit
+    if value > MAX_TRACK_ID:
+        return None
+    return value.to_bytes(16, 'big')
+
+
+def _bytes_to_track_id(raw: bytes) -> str:
+    value = int.from_bytes(raw, 'big')
+    chars = []
+    for _ in range(22):
+        value, digit = divmod(value, 62)
+        chars.append(BASE62_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def encode_uris(uris: Iterable[str]) -> bytes:
+    """Packs a set of URIs into a version 1 blob."""
+    packed_ids = []
+    other_uris = []
+    for uri in uris:
+        raw = _track_id_to_bytes(uri[len(TRACK_URI_PREFIX):]) if uri.startswith(TRACK_URI_PREFIX) else None
+        if raw is None:
+            other_uris.append(uri)
+        else:
+            packed_ids.append(raw)
+
+    # Sorting makes the blob deterministic for the same set of URIs
+    packed_ids.sort()
+    payload = struct.pack('>I', len(packed_ids)) + b''.join(packed_ids) + '\n'.join(sorted(other_uris)).encode('utf-8')
+    return zlib.compress(payload)
+
+
+def decode_uris(data: bytes, version: int = PACKED_FORMAT_VERSION) -> set:
+    """Unpacks a blob produced by encode_uris() back into a set of URIs."""
+    if version != PACKED_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version: {version}")
+
+    payload = zlib.decompress(data)
+    (count,) = struct.unpack_from('>I', payload)
+    end = 4 + count * 16
+    uris = {TRACK_URI_PREFIX + _bytes_to_track_id(payload[i:i + 16]) for i in range(4, end, 16)}
+    if end < len(payload):
+        uris.update(payload[end:].decode('utf-8').split('\n'))
+    return uris
+
+
+# --- Stores ---
+
+class RowSnapshotStore:
+    """Keeps the snapshot as one SyncedTrack row per track."""
+
+    def load(self, tracked_playlist_db_id: int) -> set:
+        return set(db.session.execute(
+            db.select(SyncedTrack.track_uri).where(SyncedTrack.tracked_playlist_id == tracked_playlist_db_id)
+        ).scalars())
+
+    def save(self, tracked_playlist_db_id: int, old_uris: set, new_uris: set):
+        """
+        Updates the snapshot from `old_uris` to `new_uris`. Does not commit.
+        Only the difference is written: removed URIs are deleted and added URIs are
+        inserted with a single executemany, instead of rewriting every row.
+        """
+        removed_uris = sorted(old_uris - new_uris)
+        added_uris = new_uris - old_uris
+
+        for i in range(0, len(removed_uris), DELETE_CHUNK_SIZE):
+            db.session.execute(db.delete(SyncedTrack).where(
+                SyncedTrack.tracked_playlist_id == tracked_playlist_db_id,
+                SyncedTrack.track_uri.in_(removed_uris[i:i + DELETE_CHUNK_SIZE])
+            ))
+
+        if added_uris:
+            db.session.execute(
+                db.insert(SyncedTrack),
+                [{"track_uri": uri, "tracked_playlist_id": tracked_playlist_db_id} for uri in added_uris]
+            )
+
+
+class PackedSnapshotStore:
+    """Keeps the snapshot as a single compressed PlaylistSnapshot blob per tracked playlist."""
+
+    def load(self, tracked_playlist_db_id: int) -> set:
+        snapshot = db.session.get(PlaylistSnapshot, tracked_playlist_db_id)
+        if snapshot is None:
+            # Not converted yet; read the legacy rows instead
+            return RowSnapshotStore().load(tracked_playlist_db_id)
+        return decode_uris(snapshot.data, snapshot.format_version)
+
+    def save(self, tracked_playlist_db_id: int, old_uris: set, new_uris: set):
+        """Replaces the snapshot blob with `new_uris`. Does not commit."""
+        snapshot = db.session.get(PlaylistSnapshot, tracked_playlist_db_id)
+        if snapshot is None:
+            # First packed save for this playlist: drop its legacy rows
+            db.session.execute(db.delete(SyncedTrack).where(SyncedTrack.tracked_playlist_id == tracked_playlist_db_id))
+            snapshot = PlaylistSnapshot(tracked_playlist_id=tracked_playlist_db_id)
+            db.session.add(snapshot)
+
+        snapshot.format_version = PACKED_FORMAT_VERSION
+        snapshot.track_count = len(new_uris)
+        snapshot.data = encode_uris(new_uris)
+        snapshot.updated_at = datetime.utcnow()
+
+
+SNAPSHOT_STORES = {
+    'rows': RowSnapshotStore,
+    'packed': PackedSnapshotStore,
+}
+
+
+def get_snapshot_store():
+    """Returns the snapshot store selected by the SNAPSHOT_STORAGE environment variable."""
+    storage = os.getenv("SNAPSHOT_STORAGE", "rows")
+    if storage not in SNAPSHOT_STORES:
+        raise ValueError(f"Unknown SNAPSHOT_STORAGE '{storage}'. Expected one of: {', '.join(SNAPSHOT_STORES)}")
+    return SNAPSHOT_STORES[storage]()
+
+
+def migrate_rows_to_packed() -> int:
+    """
+    Converts every SyncedTrack snapshot into a PlaylistSnapshot blob and deletes the rows.
+    Commits once per playlist so a large table can be converted incrementally.
+    Returns the number of playlists converted.
+    """
+    rows = RowSnapshotStore()
+    packed = PackedSnapshotStore()
+    playlist_ids = db.session.execute(db.select(SyncedTrack.tracked_playlist_id).distinct()).scalars().all()
+
+    for tracked_playlist_db_id in playlist_ids:
+        uris = rows.load(tracked_playlist_db_id)
+        existing = db.session.get(PlaylistSnapshot, tracked_playlist_db_id)
+        if existing is not None:
+            # A packed snapshot is newer than any leftover rows
+            db.session.execute(db.delete(SyncedTrack).where(SyncedTrack.tracked_playlist_id == tracked_playlist_db_id))
+        else:
+            packed.save(tracked_playlist_db_id, set(), uris)
+        db.session.commit()
+
+    logging.info(f"Packed snapshots for {len(playlist_ids)} tracked playlists.")
+    return len(playlist_ids)
@@ -0,0 +1,201 @@
+"""
+A cache of source playlist contents shared by every tracked playlist that follows them.
+
+Popular playlists (Top 50, New Music Friday) are tracked by many users, and
+each of their syncs used to download the same tracks again. Entries are keyed
+by (playlist_id, snapshot_id), so a hit is always the exact playlist Spotify
+would return; the TTL only bounds how long unused snapshots are kept.
+
+The backend is picked with SOURCE_CACHE:
+ - 'memory' (default): an LRU dict in each process.
+ - 'database': SourcePlaylistCache rows, shared by every pod and worker.
+ - 'none': disables caching.
+
+Within a process, concurrent misses for the same key share one download
+(see download_once), so N syncs of one source cost one download either way.
+"""
+import os
+import zlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, SourcePlaylistCache
+
+
+def default_ttl() -> timedelta:
+    return timedelta(seconds=int(os.getenv("SOURCE_CACHE_TTL_SECONDS", "3600")))
+
+
+def default_max_entries() -> int:
+    return int(os.getenv("SOURCE_CACHE_MAX_ENTRIES", "200"))
+
+
+def encode_uris(uris: list) -> bytes:
+    """Packs an ordered list of URIs (order matters for the source playlist)."""
+    return zlib.compress('\n'.join(uris).encode('utf-8'))
+
+
+def decode_uris(data: bytes) -> list:
+    payload = zlib.decompress(data).decode('utf-8')
+    return payload.split('\n') if payload else []
+
+
+# --- Backends ---
+
+class MemorySourceCache:
+    """Keeps up to `max_entries` playlists in this process, evicting the least recently used."""
+
+    def __init__(self, ttl: timedelta | None = None, max_entries: int | None = None):
+        self.ttl = ttl or default_ttl()
+        self.max_entries = max_entries or default_max_entries()
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, playlist_id: str, snapshot_id: str) -> list | None:
+        key = (playlist_id, snapshot_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, uris = entry
+            if datetime.utcnow() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return list(uris)
+
+    def put(self, playlist_id: str, snapshot_id: str, uris: list):
+        key = (playlist_id, snapshot_id)
+        with self.lock:
+            self.entries[key] = (datetime.utcnow(), tuple(uris))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class DatabaseSourceCache:
+    """
+    Keeps cached playlists in the source_playlist_cache table, shared by every pod.
+    Each read and write is its own short transaction on its own connection, never the
+    sync's: that commits only after the Spotify calls, and a cache row locked until then
+    would make every concurrent sync of a popular source wait its turn.
+    """
+
+    def __init__(self, ttl: timedelta | None = None, max_entries: int | None = None):
+        self.ttl = ttl or default_ttl()
+        self.max_entries = max_entries or default_max_entries()
+
+    def get(self, playlist_id: str, snapshot_id: str) -> list | None:
+        now = datetime.utcnow()
+        key = (SourcePlaylistCache.playlist_id == playlist_id, SourcePlaylistCache.snapshot_id == snapshot_id)
+        with db.engine.begin() as connection:
+            entry = connection.execute(
+                db.select(SourcePlaylistCache.data).where(*key, SourcePlaylistCache.created_at >= now - self.ttl)
+            ).first()
+            if entry is None:
+                return None
+            connection.execute(db.update(SourcePlaylistCache).where(*key).values(last_used_at=now))
+        return decode_uris(entry.data)
+
+    def put(self, playlist_id: str, snapshot_id: str, uris: list):
+        now = datetime.utcnow()
+        values = dict(
+            playlist_id=playlist_id, snapshot_id=snapshot_id, track_count=len(uris),
+            data=encode_uris(uris), created_at=now, last_used_at=now
+        )
+        # Another pod may have cached the same snapshot since we looked; theirs is identical
+        dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+        with db.engine.begin() as connection:
+            connection.execute(dialect.insert(SourcePlaylistCache).values(**values).on_conflict_do_nothing())
+            self.evict(connection, now)
+
+    def evict(self, connection, now: datetime):
+        """Deletes expired entries, then the least recently used ones beyond `max_entries`."""
+        connection.execute(db.delete(SourcePlaylistCache).where(SourcePlaylistCache.created_at < now - self.ttl))
+
+        oldest_kept = connection.execute(
+            db.select(SourcePlaylistCache.last_used_at)
+            .order_by(SourcePlaylistCache.last_used_at.desc())
+            .offset(self.max_entries - 1)
+            .limit(1)
+        ).scalar()
+        if oldest_kept is not None:
+            connection.execute(db.delete(SourcePlaylistCache).where(SourcePlaylistCache.last_used_at < oldest_kept))
+
+
+class NoSourceCache:
+    """Caches nothing."""
+
+    def get(self, playlist_id: str, snapshot_id: str) -> list | None:
+        return None
+
+    def put(self, playlist_id: str, snapshot_id: str, uris: list):
+        pass
+
+
+# The in-process cache is only useful if every caller in the process shares it
+_memory_cache = None
+_memory_cache_lock = threading.Lock()
+
+
+def get_memory_cache() -> MemorySourceCache:
+    """Returns this process's MemorySourceCache, creating it on first use."""
+    global _memory_cache
+    with _memory_cache_lock:
+        if _memory_cache is None:
+            _memory_cache = MemorySourceCache()
+        return _memory_cache
+
+
+SOURCE_CACHES = {
+    'memory': get_memory_cache,
+    'database': DatabaseSourceCache,
+    'none': NoSourceCache,
+}
+
+
+def get_source_cache():
+    """Returns the source cache selected by the SOURCE_CACHE environment variable."""
+    backend = os.getenv("SOURCE_CACHE", "memory")
+    if backend not in SOURCE_CACHES:
+        raise ValueError(f"Unknown SOURCE_CACHE '{backend}'. Expected one of: {', '.join(SOURCE_CACHES)}")
+    return SOURCE_CACHES[backend]()
+
+
+# --- Single-Flight Downloads ---
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def download_once(playlist_id: str, snapshot_id: str, download) -> list:
+    """
+    Calls `download()` for a playlist snapshot, unless another thread in this
+    process is already downloading it, in which case that result is shared.
+    """
+    key = (playlist_id, snapshot_id)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _in_flight[key] = Future()
+
+    if not is_owner:
+        logging.info(f"Waiting for the in-flight download of playlist {playlist_id}.")
+        return list(future.result())
+
+    try:
+        uris = download()
+        future.set_result(uris)
+        return uris
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
@@ -1,53 +1,390 @@
+import os
+import time
+import random
+import threading
+import contextvars
 import requests
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 
 # --- Direct Spotify API Client using 'requests' ---
 
-def get_playlist_details(token: str, playlist_id: str) -> dict:
+API_BASE_URL = "https://api.spotify.com/v1"
+
+# Server errors worth retrying. 503 means the request was not processed, so it
+# is retried for any method; the others only for idempotent methods.
+RETRYABLE_SERVER_ERRORS = {500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+# Largest page Spotify returns for playlist items, and the only fields we read from them
+MAX_PAGE_SIZE = 100
+TRACK_URI_FIELDS = "items(track(uri)),next,total"
+# Just what the edit page shows for each track
+TRACK_LISTING_FIELDS = "items(track(uri,name,artists(name),album(images))),total"
+
+# /me/playlists returns at most 50 playlists per page
+MAX_PLAYLISTS_PAGE_SIZE = 50
+
+
+class TokenBucket:
+    """
+    A thread-safe token-bucket rate limiter.
+
+    `rate` tokens are added per second up to `capacity`. A 429 from Spotify can
+    `pause()` the bucket, which makes every caller in the process wait out the
+    Retry-After window instead of just the thread that got throttled.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes one token and returns how many seconds the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def acquire(self) -> float:
+        """Blocks until a token is available. Returns the time spent waiting."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for the next `seconds` seconds."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class ClientMetrics:
+    """Thread-safe counters describing how the client has been throttled."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            "requests": 0,
+            "retries": 0,
+            "rate_limited_responses": 0,
+            "server_errors": 0,
+            "throttled_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+    def record(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self._counters[name] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+# Extra counters for the requests made in the current context; see count_requests()
+_context_metrics = contextvars.ContextVar("spotify_context_metrics", default=None)
+
+
+@contextmanager
+def count_requests():
     """
-    Fetches the full details of a specific playlist using a direct API call.
+    Counts the requests made inside the `with` block in a ClientMetrics of their own,
+    on top of the process-wide counters, which other threads' requests also go into.
+    Pages fetched on other threads are included if submitted with submit_in_context().
     """
-    api_url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
-    headers = {"Authorization": f"Bearer {token}"}
+    metrics = ClientMetrics()
+    reset_token = _context_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _context_metrics.reset(reset_token)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit(), but `fn` runs in a copy of the caller's context, so its requests are counted with the caller's."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class SpotifyClient:
+    """
+    A shared HTTP client for the Spotify Web API.
+
+    All requests go through a single pooled requests.Session per process, so
+    connections to api.spotify.com are kept alive and reused across calls,
+    pages and threads (gunicorn request threads and scheduler job threads alike).
+    Every request also passes through a shared token bucket, and 429/5xx
+    responses are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 rate_limit: float = 10.0, burst: float = 20.0, max_retries: int = 5,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0, page_workers: int = 4):
+        self.pool_size = pool_size
+        # Upper bound on concurrent page requests for a single playlist in parallel mode
+        self.page_workers = page_workers
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = TokenBucket(rate_limit, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = ClientMetrics()
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "SpotifyClient":
+        """Builds a client using the SPOTIFY_* environment variables."""
+        return cls(
+            pool_size=int(os.getenv("SPOTIFY_HTTP_POOL_SIZE", "10")),
+            connect_timeout=float(os.getenv("SPOTIFY_HTTP_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("SPOTIFY_HTTP_READ_TIMEOUT", "30")),
+            rate_limit=float(os.getenv("SPOTIFY_RATE_LIMIT", "10")),
+            burst=float(os.getenv("SPOTIFY_RATE_BURST", "20")),
+            max_retries=int(os.getenv("SPOTIFY_MAX_RETRIES", "5")),
+            page_workers=int(os.getenv("SPOTIFY_PAGE_FETCH_WORKERS", "4")),
+        )
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns the pooled session, creating it on first use.
+        A new session is built after a fork so that worker processes never
+        share sockets inherited from their parent.
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    self._session = self._build_session()
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        })
+        return session
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given (0-based) retry attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def retry_delay(self, response: requests.Response, attempt: int) -> float:
+        """How long to wait before retrying `response`, honouring Retry-After when present."""
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                # Add a little jitter so throttled threads don't all wake at once
+                return float(retry_after) + random.uniform(0, self.backoff_base)
+            except ValueError:
+                pass
+        return self.backoff_delay(attempt)
+
+    def is_retryable(self, method: str, status_code: int) -> bool:
+        if status_code == 429 or status_code == 503:
+            return True
+        return status_code in RETRYABLE_SERVER_ERRORS and method in IDEMPOTENT_METHODS
+
+    def request(self, method: str, url: str, token: str, **kwargs) -> requests.Response:
+        """
+        Sends an authorized request to the Spotify API.
+        `url` may be a full URL (e.g. a 'next' link) or a path relative to API_BASE_URL.
+        """
+        if not url.startswith("http"):
+            url = f"{API_BASE_URL}{url}"
+
+        headers = kwargs.pop("headers", {})
+        headers["Authorization"] = f"Bearer {token}"
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            waited = self.limiter.acquire()
+            self._record(requests=1, throttled_seconds=waited)
+
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if method not in IDEMPOTENT_METHODS or attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logging.warning(f"{method} {url} failed ({e}). Retrying in {delay:.1f}s.")
+                self._record(retries=1, backoff_seconds=delay)
+                time.sleep(delay)
+                continue
+
+            if attempt < self.max_retries and self.is_retryable(method, response.status_code):
+                delay = self.retry_delay(response, attempt)
+                self._record(retries=1)
+                if response.status_code == 429:
+                    # Hold back every thread in this process, not just this one.
+                    # The wait is counted as throttled time by the next acquire().
+                    logging.warning(f"Rate limited by Spotify. Pausing requests for {delay:.1f}s.")
+                    self._record(rate_limited_responses=1)
+                    self.limiter.pause(delay)
+                else:
+                    logging.warning(f"Spotify returned {response.status_code} for {method} {url}. Retrying in {delay:.1f}s.")
+                    self._record(server_errors=1, backoff_seconds=delay)
+                    time.sleep(delay)
+                continue
+
+            # Raise an error for bad status codes (4xx or 5xx)
+            response.raise_for_status()
 
-    logging.info(f"Fetching details for playlist: {playlist_id}")
-    response = requests.get(api_url, headers=headers)
+            return response
 
-    # Raise an error for bad status codes (4xx or 5xx)
-    response.raise_for_status()
+    def _record(self, **increments):
+        self.metrics.record(**increments)
+        context_metrics = _context_metrics.get()
+        if context_metrics is not None:
+            context_metrics.record(**increments)
+
+    def get(self, url: str, token: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, token, **kwargs)
+
+    def post(self, url: str, token: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, token, **kwargs)
+
+    def delete(self, url: str, token: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, token, **kwargs)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> SpotifyClient:
+    """
+    Returns the process-wide SpotifyClient.
+    It is created lazily so that settings loaded from .env are picked up.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SpotifyClient.from_env()
+    return _client
+
+
+def get_metrics() -> dict:
+    """Returns request, retry and throttling counters for this process."""
+    return get_client().metrics.snapshot()
+
+
+def get_playlist_header(token: str, playlist_id: str, fields: str = "id,name,snapshot_id") -> dict:
+    """
+    Fetches only the lightweight playlist fields (no track pages) using a `fields` filter.
+    Useful for checking whether a playlist's snapshot_id has changed.
+    """
+    logging.info(f"Fetching header for playlist: {playlist_id}")
+    response = get_client().get(f"/playlists/{playlist_id}", token, params={"fields": fields})
 
     return response.json()
 
 
-def get_all_track_uris(token: str, playlist_data: dict) -> list:
+def _track_page_uris(page: dict) -> list:
+    """Extracts the track URIs from one page of playlist items."""
+    return [item['track']['uri'] for item in page['items'] if item.get('track') and item['track'].get('uri')]
+
+
+def _fetch_track_page(token: str, playlist_id: str, offset: int) -> list:
+    """Fetches the track URIs of the page starting at `offset`."""
+    params = {"fields": TRACK_URI_FIELDS, "limit": MAX_PAGE_SIZE, "offset": offset}
+    page = get_client().get(f"/playlists/{playlist_id}/tracks", token, params=params).json()
+    return _track_page_uris(page)
+
+
+def iter_track_uris(token: str, playlist_id: str, parallel: bool = False):
     """
-    Fetches all track URIs from a playlist, handling pagination automatically.
+    Yields the URI of every track in a playlist, one page at a time.
+    Only the fields we need are requested, using Spotify's maximum page size,
+    so callers can build sets incrementally without holding full track objects.
+
+    With `parallel=True` the remaining pages are worked out from the first page's
+    `total` and fetched concurrently on a bounded thread pool (still subject to
+    the shared rate limit). URIs are yielded in playlist order either way.
     """
-    tracks = []
-    # Start with the first page of tracks from the initial playlist data
-    for item in playlist_data['tracks']['items']:
-        if item.get('track') and item['track'].get('uri'):
-            tracks.append(item['track']['uri'])
+    client = get_client()
+    params = {"fields": TRACK_URI_FIELDS, "limit": MAX_PAGE_SIZE}
+    page = client.get(f"/playlists/{playlist_id}/tracks", token, params=params).json()
+    yield from _track_page_uris(page)
+    count = len(page['items'])
 
-    # Follow the 'next' link to get subsequent pages
-    next_url = playlist_data['tracks'].get('next')
-    headers = {"Authorization": f"Bearer {token}"}
+    remaining_offsets = list(range(MAX_PAGE_SIZE, page.get('total') or 0, MAX_PAGE_SIZE))
+    if parallel and len(remaining_offsets) > 1:
+        logging.info(f"Fetching {len(remaining_offsets)} more pages of playlist {playlist_id} in parallel.")
+        executor = ThreadPoolExecutor(max_workers=client.page_workers)
+        try:
+            futures = [submit_in_context(executor, _fetch_track_page, token, playlist_id, offset) for offset in remaining_offsets]
+            for future in futures:
+                uris = future.result()
+                count += len(uris)
+                yield from uris
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        next_url = page.get('next')
+        while next_url:
+            # The 'next' link carries offset and limit; only re-add the fields filter if it was dropped
+            params = None if 'fields=' in next_url else {"fields": TRACK_URI_FIELDS}
+            page = client.get(next_url, token, params=params).json()
+            count += len(page['items'])
+            yield from _track_page_uris(page)
+            next_url = page.get('next')
 
-    while next_url:
-        logging.info("Fetching next page of tracks...")
-        response = requests.get(next_url, headers=headers)
-        response.raise_for_status()
-        next_page_data = response.json()
+    logging.info(f"Streamed {count} items from playlist {playlist_id}.")
 
-        for item in next_page_data['items']:
-            if item.get('track') and item['track'].get('uri'):
-                tracks.append(item['track']['uri'])
 
-        next_url = next_page_data.get('next')
+def get_track_listing_page(token: str, playlist_id: str, offset: int = 0, limit: int = MAX_PAGE_SIZE) -> dict:
+    """
+    Fetches one page of a playlist's tracks with only their URI, name, artists and album art.
+    Returns the raw page: 'items' and 'total'.
+    """
+    params = {"fields": TRACK_LISTING_FIELDS, "limit": limit, "offset": offset}
+    return get_client().get(f"/playlists/{playlist_id}/tracks", token, params=params).json()
+
+
+def iter_user_playlist_pages(token: str):
+    """
+    Yields the current user's playlists one page (of up to 50) at a time, following
+    the 'next' links. Each page has 'items', 'next' and 'total', so callers can stop early.
+    """
+    client = get_client()
+    page = client.get("/me/playlists", token, params={"limit": MAX_PLAYLISTS_PAGE_SIZE}).json()
+    yield page
+    while page.get('next'):
+        page = client.get(page['next'], token).json()
+        yield page
 
-    logging.info(f"Found a total of {len(tracks)} tracks.")
-    return tracks
+
+def user_follows_playlist(token: str, playlist_id: str, user_id: str) -> bool:
+    """
+    Checks whether a user still follows (or owns and hasn't deleted) a playlist, in one small request.
+    Deleting a playlist on Spotify only unfollows it, so fetching it by ID isn't enough.
+    """
+    try:
+        response = get_client().get(f"/playlists/{playlist_id}/followers/contains", token, params={"ids": user_id})
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return False
+        raise
+    return bool(response.json()[0])
 
 
 def create_new_playlist(token: str, user_id: str, playlist_name: str, description: str) -> str:
@@ -55,11 +392,7 @@ def create_new_playlist(token: str, user_id: str, playlist_name: str, descriptio
     Creates a new empty playlist for a user.
     Returns the ID of the new playlist.
     """
-    api_url = f"https://api.spotify.com/v1/users/{user_id}/playlists"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
+    headers = {"Content-Type": "application/json"}
     data = {
         "name": playlist_name,
         "public": True,
@@ -67,23 +400,21 @@ def create_new_playlist(token: str, user_id: str, playlist_name: str, descriptio
     }
 
     logging.info(f"Creating new playlist: {playlist_name}")
-    response = requests.post(api_url, headers=headers, data=json.dumps(data))
-    response.raise_for_status()
+    response = get_client().post(f"/users/{user_id}/playlists", token, headers=headers, data=json.dumps(data))
 
     playlist_id = response.json().get('id')
     logging.info(f"Playlist created with ID: {playlist_id}")
     return playlist_id
 
 
-def add_tracks_to_playlist(token: str, playlist_id: str, track_uris: list):
+def add_tracks_to_playlist(token: str, playlist_id: str, track_uris: list) -> str | None:
     """
     Adds a list of tracks to a specified playlist.
+    Returns the playlist's snapshot_id after the last chunk was added.
     """
-    api_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
+    client = get_client()
+    headers = {"Content-Type": "application/json"}
+    snapshot_id = None
 
     # Spotify API can only handle 100 tracks at a time
     for i in range(0, len(track_uris), 100):
@@ -91,6 +422,27 @@ def add_tracks_to_playlist(token: str, playlist_id: str, track_uris: list):
         data = {"uris": chunk}
 
         logging.info(f"Adding {len(chunk)} tracks to playlist {playlist_id}")
-        response = requests.post(api_url, headers=headers, data=json.dumps(data))
-        response.raise_for_status()
+        response = client.post(f"/playlists/{playlist_id}/tracks", token, headers=headers, data=json.dumps(data))
+        snapshot_id = response.json().get('snapshot_id')
+
+    return snapshot_id
+
+
+def remove_tracks_from_playlist(token: str, playlist_id: str, track_uris: list) -> str | None:
+    """
+    Removes every occurrence of each track from a playlist, 100 tracks per request.
+    Returns the playlist's snapshot_id after the last chunk was removed.
+    """
+    client = get_client()
+    headers = {"Content-Type": "application/json"}
+    snapshot_id = None
+
+    for i in range(0, len(track_uris), 100):
+        chunk = track_uris[i:i+100]
+        data = {"tracks": [{"uri": uri} for uri in chunk]}
+
+        logging.info(f"Removing {len(chunk)} tracks from playlist {playlist_id}")
+        response = client.delete(f"/playlists/{playlist_id}/tracks", token, headers=headers, data=json.dumps(data))
+        snapshot_id = response.json().get('snapshot_id')
 
+    return snapshot_id
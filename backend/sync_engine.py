@@ -0,0 +1,260 @@
+"""
+Playlist sync logic shared by the /sync route and the scheduled auto-sync job.
+
+Syncing is split in two halves:
+ - compute_diff() is a pure function: given the source playlist, the current
+   tracked playlist, our last snapshot and the disliked songs it works out what
+   to add, what the user has newly disliked and what the new snapshot is.
+ - SyncEngine does the I/O around it: fetching the inputs from Spotify and the
+   DB, adding the tracks and saving the result.
+
+Both playlists' snapshot_ids are compared with the ones stored at the last
+sync. If neither changed there is nothing to do. If only the source changed,
+the tracked playlist still matches our stored snapshot, so it isn't downloaded
+and dislike detection is skipped (the user can't have removed anything).
+"""
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+import spotify_client
+from models import db, DislikedSong
+from snapshot_store import get_snapshot_store
+from source_cache import get_source_cache, download_once
+
+
+# --- Pure Diff Core ---
+
+@dataclass
+class SyncInputs:
+    """Everything a sync needs to know about one tracked playlist."""
+    source_uris: list
+    current_uris: set
+    snapshot_uris: set
+    disliked_uris: set
+
+
+@dataclass
+class SyncDiff:
+    """The outcome of comparing a tracked playlist with its source."""
+    songs_to_add: list
+    new_dislikes: set
+    new_snapshot: set
+
+
+def compute_diff(source_uris: Iterable[str], current_uris: set, snapshot_uris: set, disliked_uris: set) -> SyncDiff:
+    """
+    Works out a sync without touching Spotify or the DB.
+
+    A song was removed by the user (a new dislike) if it was in our last snapshot
+    but is NOT in the playlist now. A song should be added if it's in the source,
+    not already in the tracked playlist, and not disliked. Songs to add keep their
+    source playlist order. The new snapshot is the current playlist plus those songs.
+    """
+    removed_uris = snapshot_uris - current_uris
+    new_dislikes = removed_uris - disliked_uris
+    skip_uris = current_uris | disliked_uris | removed_uris
+
+    songs_to_add = [uri for uri in dict.fromkeys(source_uris) if uri not in skip_uris]
+
+    return SyncDiff(
+        songs_to_add=songs_to_add,
+        new_dislikes=new_dislikes,
+        new_snapshot=current_uris.union(songs_to_add),
+    )
+
+
+def compute_diffs(batch: Iterable[SyncInputs]) -> list:
+    """Runs compute_diff() over a batch of inputs, returning the diffs in the same order."""
+    return [
+        compute_diff(inputs.source_uris, inputs.current_uris, inputs.snapshot_uris, inputs.disliked_uris)
+        for inputs in batch
+    ]
+
+
+# --- Sync Engine ---
+
+@dataclass
+class SyncResult:
+    """What a sync did, for logging and flash messages."""
+    added: int = 0
+    new_dislikes: int = 0
+    unchanged: bool = False
+
+    def summary(self) -> str:
+        if self.unchanged:
+            return "Your playlist is up to date."
+        elif self.added:
+            return f"Added {self.added} new song(s)."
+        return "No new songs."
+
+
+def add_dislikes(tracked_playlist_db_id: int, song_uris: Iterable[str]):
+    """
+    Inserts DislikedSong rows for `song_uris` in one statement. Does not commit.
+    Songs that are already disliked are skipped, so a sync and a manual dislike of the same song can overlap.
+    """
+    rows = [{"song_uri": uri, "tracked_playlist_id": tracked_playlist_db_id} for uri in song_uris]
+    if rows:
+        dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+        db.session.execute(dialect.insert(DislikedSong).on_conflict_do_nothing(), rows)
+
+
+class SyncEngine:
+    """Syncs tracked playlists with their sources using one user's access token."""
+
+    def __init__(self, token: str):
+        self.token = token
+        self.snapshots = get_snapshot_store()
+        self.source_cache = get_source_cache()
+
+    def fetch_snapshot_ids(self, tracked_playlist) -> tuple:
+        """Fetches the current snapshot IDs of the source and tracked playlists (headers only, no tracks)."""
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            source_future = spotify_client.submit_in_context(executor, spotify_client.get_playlist_header, self.token, tracked_playlist.source_playlist_id)
+            tracked_future = spotify_client.submit_in_context(executor, spotify_client.get_playlist_header, self.token, tracked_playlist.tracked_playlist_id)
+            return source_future.result().get('snapshot_id'), tracked_future.result().get('snapshot_id')
+
+    @staticmethod
+    def snapshots_unchanged(tracked_playlist, source_snapshot_id, tracked_snapshot_id) -> bool:
+        """True if neither playlist has changed since the last successful sync."""
+        return (
+            tracked_playlist.source_snapshot_id is not None
+            and tracked_playlist.source_snapshot_id == source_snapshot_id
+            and tracked_playlist.tracked_snapshot_id == tracked_snapshot_id
+        )
+
+    @staticmethod
+    def tracked_unchanged(tracked_playlist, tracked_snapshot_id) -> bool:
+        """
+        True if the user hasn't touched the tracked playlist since the last successful sync.
+        It then still matches our stored snapshot, so there's nothing to download and no new dislikes.
+        """
+        return tracked_playlist.tracked_snapshot_id is not None and tracked_playlist.tracked_snapshot_id == tracked_snapshot_id
+
+    def gather_inputs(self, tracked_playlist, source_snapshot_id: str | None = None, source_uris: list | None = None,
+                      tracked_snapshot_id: str | None = None) -> SyncInputs:
+        """
+        Collects everything a sync needs at the same time: the source and tracked
+        playlists are downloaded on worker threads while the last snapshot and the
+        disliked songs are read from the DB on this thread (the session isn't thread-safe).
+        The source comes from `source_uris` if given (a batch sync already has it),
+        or from the shared source cache when `source_snapshot_id` is cached.
+        The tracked playlist is only downloaded if `tracked_snapshot_id` shows it changed;
+        otherwise our stored snapshot stands in for it.
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            if source_uris is None:
+                source_uris = self.cached_source_uris(tracked_playlist.source_playlist_id, source_snapshot_id)
+            if source_uris is None:
+                source_future = spotify_client.submit_in_context(executor, self._download_source_uris, tracked_playlist.source_playlist_id, source_snapshot_id)
+            tracked_unchanged = self.tracked_unchanged(tracked_playlist, tracked_snapshot_id)
+            if not tracked_unchanged:
+                tracked_future = spotify_client.submit_in_context(executor, self._download_uris, tracked_playlist.tracked_playlist_id)
+
+            snapshot_uris, disliked_uris = self.load_stored_uris(tracked_playlist)
+
+            if source_uris is None:
+                source_uris = source_future.result()
+                if source_snapshot_id:
+                    self.source_cache.put(tracked_playlist.source_playlist_id, source_snapshot_id, source_uris)
+
+            if tracked_unchanged:
+                logging.info(f"Playlist {tracked_playlist.tracked_playlist_id} is unchanged since the last sync; using the stored snapshot.")
+                current_uris = set(snapshot_uris)
+            else:
+                current_uris = set(tracked_future.result())
+
+            return SyncInputs(
+                source_uris=source_uris,
+                current_uris=current_uris,
+                snapshot_uris=snapshot_uris,
+                disliked_uris=disliked_uris,
+            )
+
+    def load_stored_uris(self, tracked_playlist) -> tuple:
+        """Reads (last snapshot URIs, disliked URIs) for a tracked playlist from the DB."""
+        # Get the snapshot of tracks from our DB from the LAST successful sync
+        snapshot_uris = self.snapshots.load(tracked_playlist.id)
+
+        # Get all songs the user has ever disliked for this playlist
+        disliked_uris = set(db.session.execute(
+            db.select(DislikedSong.song_uri).where(DislikedSong.tracked_playlist_id == tracked_playlist.id)
+        ).scalars())
+        return snapshot_uris, disliked_uris
+
+    def cached_source_uris(self, playlist_id: str, snapshot_id: str | None) -> list | None:
+        if not snapshot_id:
+            return None
+        source_uris = self.source_cache.get(playlist_id, snapshot_id)
+        if source_uris is not None:
+            logging.info(f"Source playlist {playlist_id} served from the cache ({len(source_uris)} tracks).")
+        return source_uris
+
+    def source_uris(self, playlist_id: str, snapshot_id: str | None) -> list:
+        """Returns a source playlist's tracks, from the cache if possible, caching them otherwise. Does not commit."""
+        source_uris = self.cached_source_uris(playlist_id, snapshot_id)
+        if source_uris is None:
+            source_uris = self._download_source_uris(playlist_id, snapshot_id)
+            if snapshot_id:
+                self.source_cache.put(playlist_id, snapshot_id, source_uris)
+        return source_uris
+
+    def _download_source_uris(self, playlist_id: str, snapshot_id: str | None) -> list:
+        if not snapshot_id:
+            return self._download_uris(playlist_id)
+        return download_once(playlist_id, snapshot_id, lambda: self._download_uris(playlist_id))
+
+    def _download_uris(self, playlist_id: str) -> list:
+        return list(spotify_client.iter_track_uris(self.token, playlist_id, parallel=True))
+
+    def sync(self, tracked_playlist) -> SyncResult:
+        """
+        Syncs one tracked playlist and commits the result.
+        Spotify or DB errors are left to the caller, which should roll back the session.
+        """
+        source_snapshot_id, tracked_snapshot_id = self.fetch_snapshot_ids(tracked_playlist)
+        return self.sync_snapshots(tracked_playlist, source_snapshot_id, tracked_snapshot_id)
+
+    def sync_snapshots(self, tracked_playlist, source_snapshot_id, tracked_snapshot_id, source_uris: list | None = None) -> SyncResult:
+        """
+        Syncs one tracked playlist whose current snapshot IDs are already known, and commits.
+        `source_uris` can be passed in when the caller has already fetched the source.
+        """
+        # Skip the download entirely if neither playlist has changed
+        if self.snapshots_unchanged(tracked_playlist, source_snapshot_id, tracked_snapshot_id):
+            tracked_playlist.last_synced = datetime.utcnow()
+            db.session.commit()
+            return SyncResult(unchanged=True)
+
+        inputs = self.gather_inputs(tracked_playlist, source_snapshot_id, source_uris, tracked_snapshot_id)
+        diff = compute_diff(inputs.source_uris, inputs.current_uris, inputs.snapshot_uris, inputs.disliked_uris)
+
+        if diff.songs_to_add:
+            tracked_snapshot_id = spotify_client.add_tracks_to_playlist(
+                self.token, tracked_playlist.tracked_playlist_id, diff.songs_to_add
+            )
+
+        self.save(tracked_playlist, inputs, diff, source_snapshot_id, tracked_snapshot_id)
+
+        return SyncResult(
+            added=len(diff.songs_to_add),
+            new_dislikes=len(diff.new_dislikes),
+        )
+
+    def save(self, tracked_playlist, inputs: SyncInputs, diff: SyncDiff, source_snapshot_id, tracked_snapshot_id):
+        """Records new dislikes, the new snapshot and the snapshot IDs we synced against, then commits."""
+        add_dislikes(tracked_playlist.id, diff.new_dislikes)
+        if diff.new_dislikes:
+            logging.info(f"Recorded {len(diff.new_dislikes)} newly disliked songs for '{tracked_playlist.tracked_playlist_name}'.")
+
+        self.snapshots.save(tracked_playlist.id, inputs.snapshot_uris, diff.new_snapshot)
+
+        tracked_playlist.source_snapshot_id = source_snapshot_id
+        tracked_playlist.tracked_snapshot_id = tracked_snapshot_id
+        tracked_playlist.last_synced = datetime.utcnow()
+        db.session.commit()
@@ -0,0 +1,163 @@
+"""
+A database-backed queue of SyncJobs.
+
+The web app enqueues jobs (the Sync button) and the sync worker (worker.py)
+claims and runs them. Claiming uses SELECT ... FOR UPDATE SKIP LOCKED, so any
+number of worker pods can pull from the same queue without running a job twice.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, SyncJob, TrackedPlaylist
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+
+def stale_job_timeout() -> timedelta:
+    """
+    A running job whose worker hasn't sent a heartbeat (see heartbeat()) for this long
+    belongs to a worker that died, and is queued again.
+    """
+    return timedelta(minutes=float(os.getenv("SYNC_JOB_STALE_MINUTES", "30")))
+
+
+def enqueue_sync(tracked_playlist_db_id: int, trigger: str = 'manual') -> SyncJob:
+    """
+    Queues a sync for a tracked playlist and commits.
+    If one is already queued or running, that job is returned instead of adding another.
+    """
+    active_job = get_active_job(tracked_playlist_db_id)
+    if active_job:
+        return active_job
+
+    job = SyncJob(tracked_playlist_id=tracked_playlist_db_id, trigger=trigger, status=QUEUED)
+    try:
+        # A savepoint, so losing the race doesn't roll back the caller's work
+        with db.session.begin_nested():
+            db.session.add(job)
+    except IntegrityError:
+        # Queued by someone else (a double click, or the scheduler) since we looked
+        db.session.commit()
+        return get_active_job(tracked_playlist_db_id)
+    db.session.commit()
+    logging.info(f"Queued {trigger} sync job {job.id} for playlist {tracked_playlist_db_id}.")
+    return job
+
+
+def get_active_job(tracked_playlist_db_id: int) -> SyncJob | None:
+    """Returns the queued or running job for a tracked playlist, if there is one."""
+    return db.session.execute(
+        db.select(SyncJob)
+        .where(SyncJob.tracked_playlist_id == tracked_playlist_db_id, SyncJob.status.in_(ACTIVE_STATUSES))
+        .order_by(SyncJob.created_at)
+        .limit(1)
+    ).scalar_one_or_none()
+
+
+def get_active_jobs(tracked_playlist_db_ids: list) -> dict:
+    """Like get_active_job() for many playlists in one query. Returns {tracked playlist ID: job}."""
+    if not tracked_playlist_db_ids:
+        return {}
+    jobs = db.session.execute(
+        db.select(SyncJob)
+        .where(SyncJob.tracked_playlist_id.in_(tracked_playlist_db_ids), SyncJob.status.in_(ACTIVE_STATUSES))
+        .order_by(SyncJob.created_at.desc())
+    ).scalars()
+    # Oldest last, so it wins, as in get_active_job()
+    return {job.tracked_playlist_id: job for job in jobs}
+
+
+def count_jobs_since(trigger: str, since: datetime) -> int:
+    """Counts the jobs with the given trigger queued since `since`."""
+    return db.session.execute(
+        db.select(db.func.count(SyncJob.id))
+        .where(SyncJob.trigger == trigger, SyncJob.created_at >= since)
+    ).scalar()
+
+
+def claim_jobs(limit: int) -> list:
+    """
+    Marks up to `limit` of the oldest queued jobs as running and commits.
+    Jobs locked by another worker are skipped. Returns the claimed job IDs.
+    """
+    if limit <= 0:
+        return []
+
+    jobs = db.session.execute(
+        db.select(SyncJob)
+        .where(SyncJob.status == QUEUED)
+        .order_by(SyncJob.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+
+    now = datetime.utcnow()
+    for job in jobs:
+        job.status = RUNNING
+        job.started_at = now
+
+    job_ids = [job.id for job in jobs]
+    db.session.commit()
+    return job_ids
+
+
+def group_jobs_by_user(job_ids: list) -> dict:
+    """Groups job IDs by the Spotify user who owns each job's playlist, keeping their order."""
+    if not job_ids:
+        return {}
+
+    owners = dict(db.session.execute(
+        db.select(SyncJob.id, TrackedPlaylist.user_id)
+        .join(TrackedPlaylist, TrackedPlaylist.id == SyncJob.tracked_playlist_id)
+        .where(SyncJob.id.in_(job_ids))
+    ).all())
+
+    jobs_by_user = {}
+    for job_id in job_ids:
+        if job_id in owners:
+            jobs_by_user.setdefault(owners[job_id], []).append(job_id)
+    return jobs_by_user
+
+
+def heartbeat(job_ids, now: datetime | None = None):
+    """Marks running jobs as still alive and commits. The worker calls this for its in-flight jobs."""
+    if not job_ids:
+        return
+    db.session.execute(
+        db.update(SyncJob)
+        .where(SyncJob.id.in_(job_ids), SyncJob.status == RUNNING)
+        .values(heartbeat_at=now or datetime.utcnow())
+    )
+    db.session.commit()
+
+
+def finish_job(job: SyncJob, result: str | None = None, error: str | None = None):
+    """Records the outcome of a job and commits."""
+    job.status = FAILED if error else SUCCEEDED
+    job.result = result
+    job.error = error
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def requeue_stale_jobs(now: datetime | None = None) -> int:
+    """Puts jobs abandoned by a crashed worker back in the queue and commits. Returns how many."""
+    now = now or datetime.utcnow()
+    last_seen = db.func.coalesce(SyncJob.heartbeat_at, SyncJob.started_at)
+    result = db.session.execute(
+        db.update(SyncJob)
+        .where(SyncJob.status == RUNNING, last_seen < now - stale_job_timeout())
+        .values(status=QUEUED, started_at=None, heartbeat_at=None)
+    )
+    db.session.commit()
+    if result.rowcount:
+        logging.warning(f"Re-queued {result.rowcount} stale sync job(s).")
+    return result.rowcount
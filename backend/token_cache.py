@@ -0,0 +1,117 @@
+"""
+A per-user cache of Spotify access tokens, shared by the web app and the sync worker.
+
+Access tokens last an hour, so one refresh can serve every request and every
+playlist sync a user has. Tokens are refreshed only when they're about to expire.
+Each process keeps them in memory, backed by the User row, so a token refreshed
+by one pod or worker is used by all of them. A user's refresh holds a lock on
+their row (and a thread lock in the process), so concurrent requests wait for
+one refresh instead of all refreshing at once.
+"""
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+
+from models import db, User
+
+# Refresh this long before the token actually expires, so a sync never starts with a token about to lapse
+REFRESH_MARGIN_SECONDS = 300
+
+
+@dataclass
+class CachedToken:
+    access_token: str
+    expires_at: float
+
+    def is_fresh(self, now: float) -> bool:
+        return self.expires_at - REFRESH_MARGIN_SECONDS > now
+
+
+class TokenCache:
+    """
+    Caches access tokens by Spotify user ID.
+    `refresh` is called with a refresh token and returns Spotify's token info
+    (e.g. SpotifyOAuth.refresh_access_token).
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.tokens = {}
+        self.user_locks = {}
+        self.lock = threading.Lock()
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        with self.lock:
+            return self.user_locks.setdefault(user_id, threading.Lock())
+
+    def get_access_token(self, user_id: str) -> str:
+        """
+        Returns a valid access token for the user, refreshing it if needed.
+        Saves a rotated refresh token to the database. Needs an app context.
+        """
+        cached = self.tokens.get(user_id)
+        if cached and cached.is_fresh(time.time()):
+            return cached.access_token
+
+        with self._user_lock(user_id):
+            # Another thread may have refreshed while we waited for the lock
+            cached = self.tokens.get(user_id)
+            if cached and cached.is_fresh(time.time()):
+                return cached.access_token
+
+            # Locks the row until the commit below, so other pods wait for this refresh
+            user = db.session.execute(db.select(User).where(User.id == user_id).with_for_update()).scalar_one_or_none()
+            if not user or not user.refresh_token:
+                db.session.rollback()
+                raise RuntimeError(f"User {user_id} not found or has no refresh token.")
+
+            # Another pod or worker may already have refreshed it
+            shared = self._stored_token(user)
+            if shared and shared.is_fresh(time.time()):
+                db.session.commit()
+                self.tokens[user_id] = shared
+                return shared.access_token
+
+            try:
+                token_info = self.refresh(user.refresh_token)
+            except Exception:
+                db.session.rollback()
+                raise
+            self._save(user, token_info)
+            logging.info(f"Refreshed access token for user {user_id}.")
+            return token_info['access_token']
+
+    def store(self, user_id: str, token_info: dict):
+        """Saves a token Spotify just issued (e.g. at login) for everyone to use, and commits."""
+        with self._user_lock(user_id):
+            user = db.session.get(User, user_id)
+            if not user:
+                user = User(id=user_id)
+                db.session.add(user)
+            self._save(user, token_info)
+
+    def _save(self, user: User, token_info: dict):
+        # Spotify only sometimes rotates the refresh token; keep the old one otherwise
+        if token_info.get('refresh_token'):
+            user.refresh_token = token_info['refresh_token']
+
+        expires_at = token_info.get('expires_at') or time.time() + token_info.get('expires_in', 3600)
+        user.access_token = token_info['access_token']
+        user.access_token_expires_at = datetime.utcfromtimestamp(expires_at)
+        db.session.commit()
+        self.tokens[user.id] = CachedToken(token_info['access_token'], expires_at)
+
+    @staticmethod
+    def _stored_token(user: User) -> CachedToken | None:
+        if not user.access_token or not user.access_token_expires_at:
+            return None
+        expires_at = (user.access_token_expires_at - datetime(1970, 1, 1)).total_seconds()
+        return CachedToken(user.access_token, expires_at)
+
+    def invalidate(self, user_id: str):
+        """Drops a user's token here and in the database, e.g. after Spotify rejects it. Commits."""
+        self.tokens.pop(user_id, None)
+        db.session.execute(db.update(User).where(User.id == user_id).values(access_token=None, access_token_expires_at=None))
+        db.session.commit()
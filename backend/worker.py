@@ -0,0 +1,283 @@
+"""
+The sync worker: runs playlist syncs outside the web process.
+
+Start it from the backend directory with:
+    python -m worker
+
+It polls the database for auto-syncs that are due (queuing them), then claims
+queued SyncJobs and runs up to SYNC_WORKER_CONCURRENCY of them at a time.
+Jobs with the 'copy' trigger are the initial copies queued by /track (see playlist_copy.py).
+With SYNC_MODE=batch, each thread instead claims up to SYNC_BATCH_SIZE jobs
+and syncs them in one pass grouped by source playlist (see batch_sync.py).
+With SYNC_MODE=async, each thread claims up to ASYNC_SYNC_CONCURRENCY jobs and
+runs them all at once on an asyncio event loop (see async_sync.py).
+Scale it independently of the web pods; claiming is safe across any number of workers.
+"""
+import os
+import time
+import signal
+import logging
+import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import spotify_client
+import auto_sync
+import batch_sync
+import async_sync
+import playlist_copy
+import sync_queue
+import session_store
+from app import app, token_cache
+from models import db, TrackedPlaylist, SyncJob
+from sync_engine import SyncEngine
+
+CONCURRENCY = int(os.getenv("SYNC_WORKER_CONCURRENCY", "4"))
+POLL_SECONDS = float(os.getenv("SYNC_WORKER_POLL_SECONDS", "2"))
+AUTO_SYNC_POLL_SECONDS = float(os.getenv("AUTO_SYNC_POLL_SECONDS", "60"))
+SYNC_MODE = os.getenv("SYNC_MODE", "single")
+BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "50"))
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_SYNC_CONCURRENCY", "200"))
+METRICS_LOG_SECONDS = float(os.getenv("SYNC_WORKER_METRICS_LOG_SECONDS", "300"))
+# How often in-flight jobs are marked alive; keep it well under SYNC_JOB_STALE_MINUTES
+HEARTBEAT_SECONDS = float(os.getenv("SYNC_WORKER_HEARTBEAT_SECONDS", "60"))
+
+
+def sync_playlist(tracked_playlist) -> str:
+    """Syncs one tracked playlist with its owner's cached access token. Returns a summary of what changed."""
+    access_token = token_cache.get_access_token(tracked_playlist.user_id)
+    return SyncEngine(access_token).sync(tracked_playlist).summary()
+
+
+def copy_playlist(tracked_playlist) -> str:
+    """Runs (or resumes) a new tracked playlist's initial copy. Returns a summary."""
+    access_token = token_cache.get_access_token(tracked_playlist.user_id)
+    return playlist_copy.run_copy(tracked_playlist, access_token)
+
+
+def invalidate_token_on_401(error: Exception, user_id: str):
+    """Drops the user's cached token if Spotify rejected it."""
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None and error.response.status_code == 401:
+        token_cache.invalidate(user_id)
+
+
+def run_job(job_id: int):
+    """Runs one claimed SyncJob on a worker thread and records the outcome."""
+    with app.app_context():
+        job = db.session.get(SyncJob, job_id)
+        if not job:
+            # The playlist (and its jobs) were deleted after the job was claimed
+            return
+        tracked_playlist = db.session.get(TrackedPlaylist, job.tracked_playlist_id)
+        if not tracked_playlist:
+            sync_queue.finish_job(job, result="The playlist is no longer tracked.")
+            return
+
+        if job.trigger == 'scheduled' and not tracked_playlist.auto_sync_enabled:
+            logging.warning(f"Job {job_id} fired for playlist {tracked_playlist.id}, but auto-sync is disabled. Stopping.")
+            sync_queue.finish_job(job, result="Auto-sync is disabled.")
+            return
+
+        if job.trigger != 'copy' and tracked_playlist.copy_in_progress:
+            sync_queue.finish_job(job, result="Its songs are still being copied.")
+            return
+
+        logging.info(f"Running {job.trigger} sync job {job_id} for '{tracked_playlist.tracked_playlist_name}'")
+        # Read before the sync: after a rollback these rows may be gone
+        tracked_playlist_db_id, user_id = tracked_playlist.id, tracked_playlist.user_id
+        try:
+            result = copy_playlist(tracked_playlist) if job.trigger == 'copy' else sync_playlist(tracked_playlist)
+            sync_queue.finish_job(job, result=result)
+            logging.info(f"Sync job {job_id} for '{tracked_playlist.tracked_playlist_name}' complete. {result}")
+        except Exception as e:
+            db.session.rollback()
+            invalidate_token_on_401(e, user_id)
+            logging.error(f"Sync job {job_id} failed for playlist {tracked_playlist_db_id}: {e}", exc_info=True)
+            # The playlist may have been deleted, jobs and all, while the sync ran
+            job = db.session.get(SyncJob, job_id)
+            if job:
+                sync_queue.finish_job(job, error=str(e))
+
+
+def run_user_jobs(job_ids: list):
+    """Runs one user's claimed jobs in turn, so they share a single access token."""
+    for job_id in job_ids:
+        run_job(job_id)
+
+
+def load_batch(job_ids: list) -> dict:
+    """Loads claimed jobs for a batch run. Returns {tracked playlist ID: (job, tracked playlist)}."""
+    jobs_by_playlist = {}
+    for job_id in job_ids:
+        job = db.session.get(SyncJob, job_id)
+        if not job:
+            continue
+        tracked_playlist = db.session.get(TrackedPlaylist, job.tracked_playlist_id)
+        if not tracked_playlist:
+            sync_queue.finish_job(job, result="The playlist is no longer tracked.")
+            continue
+        if tracked_playlist.id in jobs_by_playlist:
+            # Only one sync per playlist per pass; this one is covered by it
+            earlier_job_id = jobs_by_playlist[tracked_playlist.id][0].id
+            sync_queue.finish_job(job, result=f"Merged into job {earlier_job_id}.")
+            continue
+        if job.trigger == 'copy' or tracked_playlist.copy_in_progress:
+            # Copies aren't batched; run_job runs the copy, or turns the sync away until it's done
+            run_job(job_id)
+            continue
+        if job.trigger == 'scheduled' and not tracked_playlist.auto_sync_enabled:
+            sync_queue.finish_job(job, result="Auto-sync is disabled.")
+            continue
+        jobs_by_playlist[tracked_playlist.id] = (job, tracked_playlist)
+    return jobs_by_playlist
+
+
+def finish_batch(jobs_by_playlist: dict, results: dict):
+    """Records each job's result, or the exception its sync raised."""
+    for tracked_playlist_db_id, (job, tracked_playlist) in jobs_by_playlist.items():
+        result = results.get(tracked_playlist_db_id)
+        if isinstance(result, Exception):
+            invalidate_token_on_401(result, tracked_playlist.user_id)
+            sync_queue.finish_job(job, error=str(result))
+        else:
+            sync_queue.finish_job(job, result=result.summary())
+
+
+def run_batch(job_ids: list):
+    """Runs a batch of claimed jobs as one fan-out pass grouped by source playlist."""
+    with app.app_context():
+        jobs_by_playlist = load_batch(job_ids)
+        results, report = batch_sync.sync_batch(
+            [tracked_playlist for job, tracked_playlist in jobs_by_playlist.values()],
+            token_cache.get_access_token
+        )
+        finish_batch(jobs_by_playlist, results)
+
+
+def run_async_batch(job_ids: list):
+    """Runs a batch of claimed jobs concurrently on one event loop (see async_sync.py)."""
+    with app.app_context():
+        jobs_by_playlist = load_batch(job_ids)
+        tracked_playlists = [tracked_playlist for job, tracked_playlist in jobs_by_playlist.values()]
+
+        # Tokens are resolved up front: the token cache blocks, and may call Spotify to refresh
+        tokens, results = {}, {}
+        for tracked_playlist in tracked_playlists:
+            if tracked_playlist.user_id in tokens:
+                continue
+            try:
+                tokens[tracked_playlist.user_id] = token_cache.get_access_token(tracked_playlist.user_id)
+            except Exception as e:
+                logging.error(f"Could not get an access token for user {tracked_playlist.user_id}: {e}")
+                tokens[tracked_playlist.user_id] = e
+
+        runnable = []
+        for tracked_playlist in tracked_playlists:
+            if isinstance(tokens[tracked_playlist.user_id], Exception):
+                results[tracked_playlist.id] = tokens[tracked_playlist.user_id]
+            else:
+                runnable.append(tracked_playlist)
+
+        results.update(async_sync.run_sync_all(runnable, tokens, ASYNC_CONCURRENCY))
+        finish_batch(jobs_by_playlist, results)
+
+
+def queue_due_auto_syncs():
+    """
+    Claims due weekly auto-syncs and turns them into queued jobs, up to
+    auto_sync.max_syncs_per_window() per window across all workers. Anything over
+    the cap stays due for the next window.
+    """
+    with auto_sync.schedule_lock() as locked:
+        if not locked:
+            logging.info("Another worker is queueing auto-syncs; skipping this poll.")
+            return
+
+        already_queued = sync_queue.count_jobs_since('scheduled', datetime.utcnow() - auto_sync.schedule_window())
+        capacity = auto_sync.max_syncs_per_window() - already_queued
+        if capacity <= 0:
+            logging.info(f"Auto-sync cap reached ({already_queued} in the last window); waiting for the next one.")
+            return
+
+        queued = auto_sync.run_due_syncs(
+            lambda tracked_playlist_db_id: sync_queue.enqueue_sync(tracked_playlist_db_id, 'scheduled'),
+            max_count=capacity
+        )
+    if queued:
+        logging.info(f"Queued {queued} due auto-sync(s).")
+
+
+def claim_tasks(free_slots: int) -> list:
+    """
+    Claims work for up to `free_slots` threads. Returns (function, job IDs) pairs:
+    a batch per thread in batch and async mode, otherwise each user's claimed jobs.
+    """
+    if SYNC_MODE in ('batch', 'async'):
+        run, batch_size = (run_batch, BATCH_SIZE) if SYNC_MODE == 'batch' else (run_async_batch, ASYNC_CONCURRENCY)
+        tasks = []
+        for _ in range(free_slots):
+            job_ids = sync_queue.claim_jobs(batch_size)
+            if not job_ids:
+                break
+            tasks.append((run, job_ids))
+        return tasks
+
+    job_ids = sync_queue.claim_jobs(free_slots)
+    return [(run_user_jobs, user_job_ids) for user_job_ids in sync_queue.group_jobs_by_user(job_ids).values()]
+
+
+def main():
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        logging.info("Sync worker stopping after in-flight jobs finish...")
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info(f"Sync worker started in {SYNC_MODE} mode with concurrency {CONCURRENCY}.")
+    with app.app_context():
+        sync_queue.requeue_stale_jobs()
+
+    # Each running future and the job IDs it's working on
+    in_flight = {}
+    last_auto_sync_poll = 0.0
+    last_metrics_log = time.monotonic()
+    last_heartbeat = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        while not stopping:
+            in_flight = {future: job_ids for future, job_ids in in_flight.items() if not future.done()}
+
+            with app.app_context():
+                # However long a batch takes, its jobs aren't requeued as stale while this worker is alive
+                if time.monotonic() - last_heartbeat >= HEARTBEAT_SECONDS:
+                    sync_queue.heartbeat([job_id for job_ids in in_flight.values() for job_id in job_ids])
+                    last_heartbeat = time.monotonic()
+
+                if time.monotonic() - last_auto_sync_poll >= AUTO_SYNC_POLL_SECONDS:
+                    queue_due_auto_syncs()
+                    sync_queue.requeue_stale_jobs()
+                    session_store.delete_expired_sessions()
+                    last_auto_sync_poll = time.monotonic()
+
+                tasks = claim_tasks(CONCURRENCY - len(in_flight))
+
+            # Running totals since start, so throttling shows up while the worker runs, not just when it stops
+            if time.monotonic() - last_metrics_log >= METRICS_LOG_SECONDS:
+                logging.info(f"Spotify client metrics: {spotify_client.get_metrics()}")
+                last_metrics_log = time.monotonic()
+
+            for run, job_ids in tasks:
+                in_flight[executor.submit(run, job_ids)] = job_ids
+
+            if not tasks:
+                time.sleep(POLL_SECONDS)
+
+    logging.info(f"Sync worker stopped. Spotify client metrics: {spotify_client.get_metrics()}")
+
+
+if __name__ == '__main__':
+    main()